@@ -1,57 +1,380 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import re
+import time
 import requests
 import json
-import pandas as pd
 from pathlib import Path
+from model_residency import ModelResidencyManager
+from concurrency import get_limiter
+from deadlines import Deadline, DeadlineExceeded
+
+try:
+    import httpx
+except ImportError:  # 仅异步接口需要 httpx（随 ollama 客户端一起安装）
+    httpx = None
+
+try:
+    from PIL import Image
+except ImportError:  # 仅在需要缩小图片（max_side）时使用 Pillow
+    Image = None
 
 # Ollama API 的基础URL (默认是本地)
 OLLAMA_API_BASE = "http://localhost:11434"
 
 import base64
 
+CAPTION_PROMPT = "请详细描述这张图片的内容。"
+
+# 多图请求：按顺序编号，要求以JSON逐张给出描述，便于拆回每个文件
+BATCH_CAPTION_PROMPT = (
+    "下面共有{count}张图片，按提供的顺序编号为1到{count}。请分别详细描述每张图片的内容。\n"
+    "只输出JSON，格式为：{{\"captions\": [{{\"index\": 1, \"caption\": \"图片1的描述\"}}, ...]}}，"
+    "必须包含全部{count}张图片，index 与图片编号一一对应。"
+)
+
 
-def analyze_image_with_ollama_api(image_path, model='llava'):
+def analyze_image_with_ollama_api(image_path, model='llava', keep_alive=None, residency=None, limiter=None,
+                                  timeout=None, max_side=None):
     """
     使用Ollama的HTTP API分析单张图片，并确保图片数据被编码为base64。
 
     Args:
         image_path (str): 图片文件的路径。
         model (str): 要使用的Ollama模型名称。
+        keep_alive (str): 模型驻留时间，未指定时使用 residency 中的设置或Ollama默认值。
+        residency (ModelResidencyManager): 用于记录加载/推理耗时（可选）。
+        limiter (AdaptiveLimiter): 并发限制器，默认与同一Ollama地址的其他调用共享。
+        timeout (float): 截止秒数（含排队时间）；超时后断开连接，Ollama随即停止生成。
+        max_side (int): 图片长边超过该像素数时先缩小再发送（需要 Pillow），减少传输与视觉编码开销。
 
     Returns:
         str: 模型生成的图片描述，如果失败则返回错误信息。
     """
-    # API 端点
-    api_url = "http://localhost:11434/api/generate"
+    try:
+        encoded_image = encode_image(image_path, max_side)
+    except Exception as e:
+        return f"❌ 处理 {image_path} 时发生未知错误: {str(e)}"
+    return _caption_encoded_image(image_path, encoded_image, model, keep_alive, residency, limiter, timeout)
+
 
+def _caption_encoded_image(image_path, encoded_image, model, keep_alive=None, residency=None, limiter=None,
+                           timeout=None):
     try:
-        # 读取图片文件为二进制数据
-        with open(image_path, 'rb') as file:
-            image_data = file.read()
+        payload = _build_payload([encoded_image], model, keep_alive, residency)
+        result = _post_generate(payload, limiter, timeout)
+        if residency is not None:
+            residency.record(model, result)
+        return result.get('response', 'No response field in result').strip()
 
-        # 将二进制数据编码为base64字符串
-        encoded_image_data = base64.b64encode(image_data).decode('utf-8')
+    except (DeadlineExceeded, requests.Timeout):
+        return f"❌ 处理 {image_path} 超时"
+    except RuntimeError as e:
+        return str(e)
+    except Exception as e:
+        return f"❌ 处理 {image_path} 时发生未知错误: {str(e)}"
 
-        # 准备要发送的JSON数据
-        payload = {
-            "model": model,
-            "prompt": "请详细描述这张图片的内容。",
-            "images": [encoded_image_data],  # 使用base64编码的图片数据
-            "stream": False #/ 设置为False以获得完整响应
-        }
 
-        # 发送POST请求
-        response = requests.post(api_url, json=payload)
+def _post_generate(payload, limiter=None, timeout=None):
+    """
+    发送 /api/generate 请求并返回响应JSON。
+
+    请求经过自适应并发限制器，延迟按生成token数归一化；HTTP错误抛出 RuntimeError，
+    超时抛出 DeadlineExceeded 或 requests.Timeout。
+    """
+    # API 端点
+    api_url = f"{OLLAMA_API_BASE}/api/generate"
+    limiter = limiter or get_limiter(OLLAMA_API_BASE)
+    deadline = Deadline(timeout)
+    with limiter.slot(deadline.remaining()) as handle:
+        response = requests.post(api_url, json=payload, timeout=deadline.remaining())
 
         # 检查HTTP状态码
         if response.status_code != 200:
-            return f"HTTP Error {response.status_code}: {response.text}"
+            raise RuntimeError(f"HTTP Error {response.status_code}: {response.text}")
 
         # 解析JSON响应
         result = response.json()
+        handle.record(result)
+    return result
+
+
+def encode_image(image_path, max_side=None):
+    """
+    读取图片并编码为base64字符串。
+
+    Args:
+        image_path (str): 图片文件的路径。
+        max_side (int): 长边超过该像素数时按比例缩小（需要 Pillow），None 表示原样发送。
+
+    Returns:
+        str: base64编码的图片数据。
+    """
+    # 读取图片文件为二进制数据
+    image_data = _read_file(image_path)
+    if max_side and Image is not None:
+        with Image.open(io.BytesIO(image_data)) as img:
+            if max(img.size) > max_side:
+                img.thumbnail((max_side, max_side))
+                buffer = io.BytesIO()
+                if img.mode in ("RGB", "L"):
+                    img.save(buffer, format="JPEG", quality=90)
+                else:
+                    img.save(buffer, format="PNG")
+                image_data = buffer.getvalue()
+
+    # 将二进制数据编码为base64字符串
+    return base64.b64encode(image_data).decode('utf-8')
+
+
+def _build_payload(encoded_images, model, keep_alive=None, residency=None, prompt=CAPTION_PROMPT, format=None):
+    # 准备要发送的JSON数据
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "images": encoded_images,  # 使用base64编码的图片数据
+        "stream": False #/ 设置为False以获得完整响应
+    }
+    if format is not None:
+        payload["format"] = format
+    if keep_alive is None and residency is not None:
+        keep_alive = residency.keep_alive_for(model)
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+    return payload
+
+
+def _read_file(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def parse_batch_captions(text, count):
+    """
+    把多图请求的响应拆分为每张图片的描述。
+
+    支持 {"captions": [{"index": 1, "caption": "..."}]}、JSON数组以及 "1. ..." 形式的编号列表。
+
+    Args:
+        text (str): 模型响应。
+        count (int): 请求中的图片数量。
+
+    Returns:
+        list: 按图片顺序排列的描述；缺少、重复或无法解析时返回 None。
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        data = data.get("captions") or data.get("images")
+
+    captions = {}
+    if isinstance(data, list):
+        for position, item in enumerate(data, 1):
+            if isinstance(item, dict):
+                index = item.get("index", position)
+                caption = item.get("caption") or item.get("description")
+            else:
+                index, caption = position, item
+            try:
+                index = int(index)
+            except (TypeError, ValueError):
+                return None
+            if not isinstance(caption, str) or not caption.strip() or index in captions:
+                return None
+            captions[index] = caption.strip()
+    elif data is None:
+        for match in re.finditer(r"^\s*(?:图片)?(\d+)\s*[.、:：)）]\s*(.+?)\s*$", text, re.M):
+            index = int(match.group(1))
+            if index in captions:
+                return None
+            captions[index] = match.group(2)
+
+    if sorted(captions) != list(range(1, count + 1)):
+        return None
+    return [captions[index] for index in range(1, count + 1)]
+
+
+def analyze_image_batch(image_paths, model='llava', keep_alive=None, residency=None, limiter=None, timeout=None,
+                        max_side=None):
+    """
+    在一次 /api/generate 请求中描述多张图片。
+
+    所有图片放入同一个 images 数组，共用一次请求开销和提示词预填充；
+    响应按编号拆回每张图片。响应格式不正确或请求被拒绝时，这些图片改为逐张描述。
+
+    Args:
+        image_paths (list): 图片文件路径列表。
+        其余参数与 analyze_image_with_ollama_api 相同。
+
+    Returns:
+        list: 与 image_paths 顺序一致的描述或错误信息。
+    """
+    try:
+        encoded_images = [encode_image(path, max_side) for path in image_paths]
+    except Exception:
+        # 个别图片无法读取时逐张处理，错误只出现在对应的行
+        return [analyze_image_with_ollama_api(path, model=model, keep_alive=keep_alive, residency=residency,
+                                              limiter=limiter, timeout=timeout, max_side=max_side)
+                for path in image_paths]
+    return caption_encoded_images(image_paths, encoded_images, model=model, keep_alive=keep_alive,
+                                  residency=residency, limiter=limiter, timeout=timeout)
+
+
+def caption_encoded_images(image_paths, encoded_images, model='llava', keep_alive=None, residency=None, limiter=None,
+                           timeout=None):
+    """
+    描述已编码（base64）的一组图片，多张时合并为一次请求，格式不正确时逐张重试。
+
+    Args:
+        image_paths (list): 图片路径，用于错误信息。
+        encoded_images (list): 与 image_paths 对应的base64图片数据（见 encode_image）。
+
+    Returns:
+        list: 与 image_paths 顺序一致的描述或错误信息。
+    """
+    def single(path, encoded_image):
+        return _caption_encoded_image(path, encoded_image, model, keep_alive, residency, limiter, timeout)
+
+    if len(image_paths) == 1:
+        return [single(image_paths[0], encoded_images[0])]
+
+    try:
+        payload = _build_payload(list(encoded_images), model, keep_alive, residency,
+                                 prompt=BATCH_CAPTION_PROMPT.format(count=len(image_paths)), format="json")
+        result = _post_generate(payload, limiter, timeout)
+        if residency is not None:
+            residency.record(model, result)
+        captions = parse_batch_captions(result.get('response', ''), len(image_paths))
+    except (DeadlineExceeded, requests.Timeout):
+        return [f"❌ 处理 {path} 超时" for path in image_paths]
+    except Exception as e:
+        print(f"⚠️  多图请求失败，改为逐张描述: {str(e)}")
+        captions = None
+    else:
+        if captions is None:
+            print(f"⚠️  {len(image_paths)} 张图片的批量描述格式不正确，改为逐张描述")
+
+    if captions is None:
+        return [single(path, encoded_image) for path, encoded_image in zip(image_paths, encoded_images)]
+    return captions
+
+
+def analyze_images_batched(image_paths, model='llava', batch_size=4, keep_alive=None, residency=None, limiter=None,
+                           timeout=None, max_side=None):
+    """
+    按 batch_size 分组描述图片。
+
+    Returns:
+        list: 与 image_paths 顺序一致的描述或错误信息。
+    """
+    image_paths = [str(path) for path in image_paths]
+    descriptions = []
+    for start in range(0, len(image_paths), batch_size):
+        batch = image_paths[start:start + batch_size]
+        print(f"  ({start + len(batch)}/{len(image_paths)}) 正在处理: {', '.join(Path(p).name for p in batch)}")
+        descriptions.extend(analyze_image_batch(batch, model=model, keep_alive=keep_alive, residency=residency,
+                                                limiter=limiter, timeout=timeout, max_side=max_side))
+    return descriptions
+
+
+def benchmark_captioning(image_paths, model='llava', batch_sizes=(1, 4), max_side=None, residency=None):
+    """
+    比较逐张与多图批量描述的吞吐量。
+
+    Args:
+        image_paths (list): 用于测试的图片路径。
+        batch_sizes (tuple): 要比较的每次请求图片数，1 即逐张描述。
+
+    Returns:
+        dict: {每次请求图片数: 每秒处理的图片数}
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        analyze_images_batched(image_paths, model=model, batch_size=batch_size, residency=residency,
+                               max_side=max_side)
+        elapsed = time.perf_counter() - start
+        results[batch_size] = len(image_paths) / elapsed if elapsed > 0 else 0.0
+        print(f"⏱️  每次 {batch_size} 张: {len(image_paths)} 张图片耗时 {elapsed:.2f} 秒，"
+              f"{results[batch_size]:.2f} 张/秒")
+    return results
+
+
+async def aanalyze_image_with_ollama_api(image_path, model='llava', keep_alive=None, residency=None, limiter=None,
+                                         timeout=None, client=None):
+    """
+    analyze_image_with_ollama_api 的异步版本，供 asyncio 服务使用。
+
+    图片在线程中读取，请求通过 httpx.AsyncClient 发送，等待并发额度和响应时都不阻塞事件循环；
+    任务被取消时连接随即断开，Ollama停止生成。
+
+    Args:
+        client (httpx.AsyncClient): 复用的异步HTTP客户端（可选），未提供时为本次调用单独创建。
+        其余参数与 analyze_image_with_ollama_api 相同。
+
+    Returns:
+        str: 模型生成的图片描述，如果失败则返回错误信息。
+    """
+    if httpx is None:
+        raise ImportError("异步图片分析需要安装 httpx")
+    own_client = client is None
+    if own_client:
+        client = httpx.AsyncClient(base_url=OLLAMA_API_BASE)
+
+    try:
+        encoded_image = await asyncio.to_thread(encode_image, image_path)
+        payload = _build_payload([encoded_image], model, keep_alive, residency)
+
+        limiter = limiter or get_limiter(OLLAMA_API_BASE)
+        deadline = Deadline(timeout)
+        async with limiter.aslot(deadline.remaining()) as handle:
+            response = await client.post(f"{OLLAMA_API_BASE}/api/generate", json=payload,
+                                         timeout=deadline.remaining())
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP Error {response.status_code}: {response.text}")
+            result = response.json()
+            handle.record(result)
+        if residency is not None:
+            residency.record(model, result)
         return result.get('response', 'No response field in result').strip()
 
+    except (DeadlineExceeded, httpx.TimeoutException):
+        return f"❌ 处理 {image_path} 超时"
+    except RuntimeError as e:
+        return str(e)
     except Exception as e:
         return f"❌ 处理 {image_path} 时发生未知错误: {str(e)}"
+    finally:
+        if own_client:
+            await client.aclose()
+
+
+async def aanalyze_images(image_paths, model='llava', keep_alive=None, residency=None, limiter=None, timeout=None):
+    """
+    并发分析多张图片，结果保存在内存中返回，不写Excel。
+
+    所有图片共用一个 httpx.AsyncClient（连接复用），实际在途请求数由并发限制器控制。
+
+    Returns:
+        list: [{'Image Path': ..., 'Image Name': ..., 'Description': ...}]，顺序与输入一致。
+    """
+    if httpx is None:
+        raise ImportError("异步图片分析需要安装 httpx")
+    async with httpx.AsyncClient(base_url=OLLAMA_API_BASE) as client:
+        descriptions = await asyncio.gather(*(
+            aanalyze_image_with_ollama_api(str(path), model=model, keep_alive=keep_alive, residency=residency,
+                                           limiter=limiter, timeout=timeout, client=client)
+            for path in image_paths
+        ))
+    return [{
+        'Image Path': str(Path(path).resolve()),
+        'Image Name': Path(path).name,
+        'Description': description
+    } for path, description in zip(image_paths, descriptions)]
 
 
 def main():
@@ -59,43 +382,72 @@ def main():
     images_folder = r"C:\Users\16846\Desktop\保密\PDF2WEB\extracted\test\images"  # <-- 修改为你的图片文件夹路径
     output_excel = "image_descriptions_api.xlsx"
     model_name = "qwen2.5vl:7b"  # 确保这个模型已经通过 `ollama run llava` 下载
+    batch_size = 1  # 每次请求的图片数，大于1时多张图片合并为一次请求
     # === 配置结束 ===
 
+    parser = argparse.ArgumentParser(description="通过Ollama API批量生成图片描述")
+    parser.add_argument("folder", nargs="?", default=images_folder, help="图片文件夹")
+    parser.add_argument("-o", "--output", default=output_excel, help="输出Excel文件")
+    parser.add_argument("--model", default=model_name, help="Ollama 视觉模型名称")
+    parser.add_argument("--batch-size", type=int, default=batch_size, help="每次请求的图片数")
+    parser.add_argument("--max-side", type=int, help="发送前把图片长边缩小到该像素数（需要 Pillow）")
+    parser.add_argument("--benchmark", action="store_true", help="比较逐张与批量描述的吞吐量，不写Excel")
+    parser.add_argument("--catalog", help="同时输出JSON Lines图片目录（每行 {\"url\", \"caption\"}）")
+    parser.add_argument("--workers", type=int, default=4, help="推理线程数")
+    parser.add_argument("--encode-workers", type=int, help="读取/编码进程数，默认CPU核数")
+    parser.add_argument("--queue-size", type=int, default=16, help="流水线各阶段之间的队列长度")
+    parser.add_argument("--profile", nargs="?", const="profile_captioning", metavar="PREFIX",
+                        help="剖析各阶段的CPU/等待Ollama时间与内存，输出 PREFIX.collapsed 等文件")
+    args = parser.parse_args()
+
+    if args.profile:
+        from profiling import Profiler
+        profiler = Profiler(args.profile)
+    else:
+        profiler = contextlib.nullcontext()
+    with profiler:
+        _caption_folder(args)
+
+
+def _caption_folder(args):
+    images_folder, output_excel, model_name = args.folder, args.output, args.model
+
     folder_path = Path(images_folder)
     if not folder_path.exists():
         print(f"❌ 错误：指定的图片文件夹不存在: {images_folder}")
         return
 
-    image_extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.webp'}
-    image_files = [f for f in folder_path.iterdir()
-                   if f.is_file() and f.suffix.lower() in image_extensions]
+    from image_pipeline import ImageCaptionPipeline, iter_image_files
 
-    if not image_files:
+    if next(iter_image_files(folder_path), None) is None:
         print(f"❌ 在文件夹 {images_folder} 中未找到任何支持的图片文件。")
         return
 
-    print(f"✅ 找到 {len(image_files)} 张图片，开始通过API分析...")
+    # 预热视觉模型并保持驻留，避免逐张调用时反复加载
+    residency = ModelResidencyManager(OLLAMA_API_BASE, default_keep_alive="30m")
+    residency.warm_up([model_name])
 
-    results = []
+    if args.benchmark:
+        image_files = list(iter_image_files(folder_path))
+        benchmark_captioning(image_files, model=model_name, batch_sizes=(1, max(2, args.batch_size)),
+                             max_side=args.max_side, residency=residency)
+        residency.print_report()
+        return
 
-    for idx, image_file in enumerate(image_files, 1):
-        print(f"  ({idx}/{len(image_files)}) 正在处理: {image_file.name}")
-        description = analyze_image_with_ollama_api(str(image_file), model=model_name)
-        results.append({
-            'Image Path': str(image_file.resolve()),
-            'Image Name': image_file.name,
-            'Description': description
-        })
+    print("✅ 开始通过API分析...")
 
-    # 创建DataFrame并保存到Excel
-    df = pd.DataFrame(results)
+    # 扫描、编码、推理、写入各阶段流水线并行，结果逐行写入Excel
+    pipeline = ImageCaptionPipeline(model=model_name, batch_size=args.batch_size, encode_workers=args.encode_workers,
+                                    inference_workers=args.workers, queue_size=args.queue_size,
+                                    max_side=args.max_side, residency=residency)
     try:
-        df.to_excel(output_excel, index=False)
+        summary = pipeline.run(folder_path, excel_path=output_excel, catalog_path=args.catalog)
         print(f"\n🎉 成功！结果已保存到 '{output_excel}'")
-        print(f"共处理了 {len(results)} 张图片。")
+        print(f"共处理了 {summary['images']} 张图片。")
+        pipeline.print_report(summary)
+        residency.print_report()
     except Exception as e:
-        print(f"❌ 保存Excel文件失败: {e}")
-
+        print(f"❌ 图片描述失败: {e}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,6 +1,6 @@
 # ppt_text_agent.py
 
-from langchain_ollama import ChatOllama
+from concurrency import LimitedChatOllama
 from langchain.agents import initialize_agent, AgentType
 from langchain.tools import Tool
 from langchain_core.prompts import PromptTemplate
@@ -12,7 +12,8 @@ os.environ["LANGCHAIN_TRACING_V2"] = "false"  # 关闭追踪，除非你用了 L
 
 # === 初始化本地大模型（通过 Ollama）===
 # 可替换 model 为你本地加载的模型名，如 llama3, qwen:7b, phi3 等
-llm = ChatOllama(
+# 所有调用经过该 Ollama 地址共享的自适应并发限制器（见 concurrency.py）
+llm = LimitedChatOllama(
     model="qwen2.5:7b",  # 改成你想用的本地模型
     temperature=0.3,
     base_url="http://localhost:11434",  # 默认地址
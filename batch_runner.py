@@ -0,0 +1,260 @@
+# batch_runner.py
+# JSONL 批量生成：从任务文件流式读取，线程池并发执行，完成一个写一行，可断点续跑
+#
+# 任务文件每行一个JSON对象：
+#   {"job_id": "a1", "text": "...", "title": "...", "style": "creative", "image_folder": "img"}
+#   {"job_id": "a2", "text": "...", "images": [{"url": "...", "caption": "..."}]}
+#   {"job_id": "a3", "text": "...", "image_folder": "img", "caption_model": "qwen2.5vl:7b"}
+# 没有 job_id（或 id）的行使用 "line-<行号>" 作为任务ID。
+#
+# 带 caption_model 的任务先用视觉模型为 image_folder 中的图片生成描述，再生成PPT。
+# 这类任务攒够一个窗口（max_pending）后统一处理：先等在途的文本生成完成，
+# 再经 ModelResidencyManager.run_grouped 按视觉模型分组描述图片，最后提交文本生成，
+# 避免视觉模型与文本模型逐个任务交替调用、反复换入显存。
+#
+# 输出文件每行一个结果：
+#   {"job_id": "a1", "success": true, "elapsed": 12.3, "result": {...}}
+#   {"job_id": "a2", "success": false, "elapsed": 0.5, "error": "..."}
+#
+# 用法:
+#     python batch_runner.py jobs.jsonl -o results.jsonl --workers 4
+
+import argparse
+import contextlib
+import json
+import os
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+JOB_FIELDS = ("text", "title", "style", "images", "image_folder")
+
+
+def iter_jobs(jobs_path):
+    """
+    流式读取任务文件
+
+    参数:
+        jobs_path: JSONL 任务文件路径
+
+    返回:
+        (任务ID, 任务字典) 生成器，无法解析或缺少 text 的行会被跳过
+    """
+    with open(jobs_path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"⚠️  第 {line_no} 行不是有效的JSON，已跳过: {str(e)}")
+                continue
+            if not isinstance(job, dict) or not job.get("text"):
+                print(f"⚠️  第 {line_no} 行缺少 text 字段，已跳过")
+                continue
+            job_id = str(job.get("job_id") or job.get("id") or f"line-{line_no}")
+            yield job_id, job
+
+
+def load_done_ids(output_path, include_failed=False):
+    """
+    读取已有输出中已完成的任务ID
+
+    参数:
+        output_path: JSONL 输出文件路径
+        include_failed: 是否把失败的任务也视为已完成（默认失败的任务在续跑时重试）
+
+    返回:
+        任务ID集合
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 中断时可能留下不完整的最后一行
+                continue
+            if record.get("success") or include_failed:
+                done.add(str(record.get("job_id")))
+    return done
+
+
+def _terminate_last_line(output_path):
+    """中断时写了一半的最后一行没有换行，追加前补上，避免新记录接在它后面"""
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        return
+    with open(output_path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def _caption_job(generator, job):
+    """
+    用任务指定的视觉模型描述 image_folder 中的图片，返回替换为 images 列表的任务
+
+    选取的图片与 PPTGenerator.load_images_from_folder 相同（同样的扩展名、排序和数量上限）
+    """
+    from Image_Recognition import analyze_images_batched
+    from image_pipeline import DEFAULT_MAX_IMAGES, list_image_files
+
+    paths = list_image_files(job["image_folder"], DEFAULT_MAX_IMAGES)
+    descriptions = analyze_images_batched(paths, model=job["caption_model"],
+                                          batch_size=job.get("caption_batch_size", 1),
+                                          residency=generator.residency)
+    images = [{"url": Path(path).resolve().as_uri(), "path": os.path.abspath(path), "caption": description}
+              for path, description in zip(paths, descriptions)]
+    job = {key: value for key, value in job.items() if key != "image_folder"}
+    job["images"] = images
+    return job
+
+
+def _safe_caption(generator, job):
+    try:
+        return _caption_job(generator, job)
+    except Exception as e:
+        return e
+
+
+def _run_job(generator, job):
+    start = time.perf_counter()
+    try:
+        kwargs = {key: job[key] for key in JOB_FIELDS if key in job}
+        result = generator.build_result(**kwargs)
+        record = {"success": True, "result": result["result"]}
+    except Exception as e:
+        record = {"success": False, "error": str(e)}
+    record["elapsed"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def run_batch(jobs_path, output_path, generator, workers=4, max_pending=None, retry_failed=True):
+    """
+    并发执行任务文件中的所有任务，每完成一个立即追加到输出文件
+
+    已在输出文件中成功完成的任务会被跳过，因此中断后重新运行即可续跑。
+    任务按提交窗口（max_pending）分批读取，不会一次性把整个任务文件读入内存。
+
+    参数:
+        jobs_path: JSONL 任务文件路径
+        output_path: JSONL 输出文件路径
+        generator: PPTGenerator 实例（多个线程共享）
+        workers: 并发线程数
+        max_pending: 同时在途的最大任务数，默认 workers * 2；
+            当 generator 的并发限制器出现排队时，会先等待已提交的任务完成再继续读取
+        retry_failed: 是否重试之前失败的任务
+
+    返回:
+        {"completed": 成功数, "failed": 失败数, "skipped": 跳过数}
+    """
+    max_pending = max_pending or workers * 2
+    limiter = getattr(generator, "limiter", None)
+    done_ids = load_done_ids(output_path, include_failed=not retry_failed)
+    stats = {"completed": 0, "failed": 0, "skipped": 0}
+    if done_ids:
+        print(f"♻️  输出文件中已有 {len(done_ids)} 个已完成任务，将跳过")
+    _terminate_last_line(output_path)
+
+    with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+
+        def drain(return_when):
+            finished, _ = wait(pending, return_when=return_when)
+            for future in finished:
+                job_id = pending.pop(future)
+                record = {"job_id": job_id, **future.result()}
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                if record["success"]:
+                    stats["completed"] += 1
+                    print(f"✅ 任务 {job_id} 完成，耗时 {record['elapsed']:.1f} 秒")
+                else:
+                    stats["failed"] += 1
+                    print(f"❌ 任务 {job_id} 失败: {record['error']}")
+
+        def submit(job_id, job):
+            # 背压：在途任务已满，或Ollama调用已在限制器上排队时，暂停读取新任务
+            while pending and (len(pending) >= max_pending or (limiter is not None and limiter.saturated())):
+                drain(FIRST_COMPLETED)
+            pending[pool.submit(_run_job, generator, job)] = job_id
+
+        caption_window = []
+
+        def flush_captions():
+            if not caption_window:
+                return
+            # 先让在途的文本生成完成，再集中调用视觉模型，最后切回文本模型
+            if pending:
+                drain(ALL_COMPLETED)
+            print(f"🖼️ 正在为 {len(caption_window)} 个任务描述图片...")
+            captioned = generator.residency.run_grouped(
+                [(job["caption_model"], lambda job=job: _safe_caption(generator, job)) for _, job in caption_window],
+                workers=workers)
+            for (job_id, _), job in zip(caption_window, captioned):
+                if isinstance(job, Exception):
+                    record = {"job_id": job_id, "success": False, "error": f"图片描述失败: {str(job)}", "elapsed": 0.0}
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    out.flush()
+                    stats["failed"] += 1
+                    print(f"❌ 任务 {job_id} 失败: {record['error']}")
+                else:
+                    submit(job_id, job)
+            caption_window.clear()
+
+        for job_id, job in iter_jobs(jobs_path):
+            if job_id in done_ids:
+                stats["skipped"] += 1
+                continue
+            # 同一文件中重复的任务ID只执行一次
+            done_ids.add(job_id)
+            if job.get("caption_model") and job.get("image_folder"):
+                caption_window.append((job_id, job))
+                if len(caption_window) >= max_pending:
+                    flush_captions()
+                continue
+            submit(job_id, job)
+
+        flush_captions()
+        while pending:
+            drain(FIRST_COMPLETED)
+
+    if limiter is not None:
+        print(f"📈 并发限制器状态: {limiter.stats()}")
+    print(f"\n🎉 批量任务结束：成功 {stats['completed']}，失败 {stats['failed']}，跳过 {stats['skipped']}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="从JSONL任务文件批量生成PPT提示词")
+    parser.add_argument("jobs", help="JSONL 任务文件")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl", help="JSONL 输出文件（追加写入）")
+    parser.add_argument("--workers", type=int, default=4, help="并发线程数")
+    parser.add_argument("--max-pending", type=int, help="同时在途的最大任务数，默认 workers*2")
+    parser.add_argument("--no-retry-failed", action="store_true", help="续跑时不重试之前失败的任务")
+    parser.add_argument("--model", default="qwen2.5:7b", help="Ollama 模型名称")
+    parser.add_argument("--base-url", default="http://localhost:11434", help="Ollama 服务地址")
+    parser.add_argument("--profile", nargs="?", const="profile_batch", metavar="PREFIX",
+                        help="剖析各阶段的CPU/等待Ollama时间与内存，输出 PREFIX.collapsed 等文件")
+    args = parser.parse_args()
+
+    from ppt_generator import PPTGenerator
+
+    if args.profile:
+        from profiling import Profiler
+        profiler = Profiler(args.profile)
+    else:
+        profiler = contextlib.nullcontext()
+    with profiler:
+        generator = PPTGenerator(model=args.model, base_url=args.base_url, warm_up=True)
+        run_batch(args.jobs, args.output, generator, workers=args.workers,
+                  max_pending=args.max_pending, retry_failed=not args.no_retry_failed)
+        generator.residency.print_report()
+        generator.stage_metrics.print_report()
+
+
+if __name__ == "__main__":
+    main()
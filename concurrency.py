@@ -0,0 +1,486 @@
+# concurrency.py
+# Ollama 调用的自适应并发控制
+#
+# 固定的并发数要么太小（Ollama 节点空闲），要么太大（排队、超时、显存压力）。
+# AdaptiveLimiter 放在所有 ChatOllama 与 /api/generate 调用之前：
+#   - 测量每次调用的延迟（扣除模型加载与提示词预填充后按生成 token 数归一化），
+#     用 AIMD 或梯度算法调整在途并发上限
+#   - 在途调用达到上限时阻塞调用方，对批量任务、图片分析等生产者形成背压
+#   - 通过 limit / in_flight / queue_depth / stats() 暴露当前状态
+#   - 线程中使用 slot()，asyncio 协程中使用 aslot()，两者共享同一份并发额度
+
+import asyncio
+import math
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any
+
+from deadlines import DeadlineExceeded, current_deadline
+from ollama_metadata import chat_result_metadata, seconds
+
+try:
+    import httpx
+    from langchain_ollama import ChatOllama
+    from ollama import Client
+except ImportError:  # 仅使用 HTTP 接口（如 Image_Recognition.py）时不需要 langchain
+    ChatOllama = None
+
+try:
+    from langchain_ollama._utils import merge_auth_headers, parse_url_with_auth
+except ImportError:  # 旧版 langchain_ollama 不支持在 base_url 中携带认证信息
+    parse_url_with_auth = None
+
+
+class AdaptiveLimiter:
+    """
+    自适应并发限制器
+
+    参数:
+        initial_limit: 初始并发上限
+        min_limit: 并发上限的下限
+        max_limit: 并发上限的上限
+        algorithm: "aimd"（加性增、乘性减）或 "gradient"（按长短期延迟比调整）
+        backoff: AIMD 在延迟超标或出错时的乘性减系数；减小后要等当时在途的一轮调用（原上限个）完成才会再次减小
+        tolerance: 延迟超过长期基线多少倍视为拥塞
+        smoothing: 梯度算法中新上限的平滑系数
+    """
+
+    def __init__(self, initial_limit=2, min_limit=1, max_limit=16, algorithm="aimd",
+                 backoff=0.75, tolerance=1.5, smoothing=0.2):
+        if algorithm not in ("aimd", "gradient"):
+            raise ValueError(f"不支持的并发控制算法: {algorithm}")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.algorithm = algorithm
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._waiting = 0
+        self._short_latency = None  # 最近延迟的快速指数平均
+        self._long_latency = None   # 长期基线延迟
+        self._samples = 0
+        self._errors = 0
+        self._completions = 0
+        self._hold_until = 0  # 完成数达到此值之前不再减小上限
+        self._cond = threading.Condition()
+        self._async_waiters = deque()  # 等待额度的协程：(事件循环, future)
+
+    @property
+    def limit(self):
+        """当前并发上限"""
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        """正在执行的调用数"""
+        return self._in_flight
+
+    @property
+    def queue_depth(self):
+        """等待获取并发额度的调用数"""
+        return self._waiting
+
+    def saturated(self):
+        """等待队列是否已达到并发上限，生产者可据此暂停提交新任务"""
+        return self._waiting >= self.limit
+
+    def acquire(self, timeout=None):
+        """
+        获取一个并发额度，达到上限时阻塞
+
+        参数:
+            timeout: 最长等待秒数，None 表示一直等待
+
+        返回:
+            是否获取成功
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._waiting += 1
+            try:
+                while self._in_flight >= self.limit:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                self._in_flight += 1
+                return True
+            finally:
+                self._waiting -= 1
+
+    async def aacquire(self, timeout=None):
+        """
+        acquire 的协程版本：等待额度时不阻塞事件循环
+
+        参数:
+            timeout: 最长等待秒数，None 表示一直等待
+
+        返回:
+            是否获取成功
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._waiting += 1
+        try:
+            while True:
+                with self._cond:
+                    if self._in_flight < self.limit:
+                        self._in_flight += 1
+                        return True
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                try:
+                    await asyncio.wait_for(waiter, remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._cond:
+                self._waiting -= 1
+
+    def release(self, latency=None, error=False):
+        """
+        释放并发额度并根据本次调用结果调整上限
+
+        参数:
+            latency: 本次调用的（归一化）延迟，None 表示不参与调整
+            error: 调用是否失败或超时
+        """
+        with self._cond:
+            self._in_flight -= 1
+            self._completions += 1
+            if error:
+                self._errors += 1
+                self._decrease()
+            elif latency is not None:
+                self._update(latency)
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, deque()
+        # release 可能在其他线程中调用，通过 call_soon_threadsafe 唤醒等待的协程
+        for loop, waiter in waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(_wake, waiter)
+
+    @contextmanager
+    def slot(self, timeout=None):
+        """
+        以上下文管理器方式占用一个并发额度并自动记录延迟
+
+        参数:
+            timeout: 等待额度的最长秒数，超时抛出 DeadlineExceeded
+
+        调用方可用 handle.record(Ollama返回的元数据) 设置生成的 token 数和模型加载、提示词预填充耗时，
+        延迟扣除后者并按 token 数归一化，避免长输出或长提示词被误判为拥塞::
+
+            with limiter.slot() as handle:
+                result = call()
+                handle.record(result)
+        """
+        if not self.acquire(timeout):
+            raise DeadlineExceeded("等待Ollama并发额度超时")
+        handle = _SlotHandle()
+        start = time.perf_counter()
+        try:
+            yield handle
+        except GeneratorExit:
+            # 流式调用被提前关闭（如提前停止生成）不算失败
+            self.release(latency=handle.latency(start))
+            raise
+        except DeadlineExceeded:
+            # 调用方的截止时间或取消（如对冲请求中落后的一方）不代表服务拥塞，不调整上限
+            self.release()
+            raise
+        except BaseException:
+            self.release(error=True)
+            raise
+        self.release(latency=handle.latency(start))
+
+    @asynccontextmanager
+    async def aslot(self, timeout=None):
+        """
+        slot 的协程版本::
+
+            async with limiter.aslot() as handle:
+                result = await call()
+                handle.record(result)
+
+        任务被取消（如截止时间到达、对冲请求中落后的一方）时不调整上限。
+        """
+        if not await self.aacquire(timeout):
+            raise DeadlineExceeded("等待Ollama并发额度超时")
+        handle = _SlotHandle()
+        start = time.perf_counter()
+        try:
+            yield handle
+        except GeneratorExit:
+            self.release(latency=handle.latency(start))
+            raise
+        except (DeadlineExceeded, asyncio.CancelledError):
+            self.release()
+            raise
+        except BaseException:
+            self.release(error=True)
+            raise
+        self.release(latency=handle.latency(start))
+
+    def _update(self, latency):
+        self._samples += 1
+        if self._short_latency is None:
+            self._short_latency = self._long_latency = latency
+            return
+        self._short_latency = 0.5 * self._short_latency + 0.5 * latency
+        self._long_latency = 0.95 * self._long_latency + 0.05 * latency
+
+        if self.algorithm == "aimd":
+            if self._short_latency > self._long_latency * self.tolerance:
+                self._decrease()
+                return
+            if self._in_flight + 1 >= self.limit:
+                # 只有在额度被用满时才增加，避免空闲时上限无限增长
+                new_limit = self._limit + 1.0 / self._limit
+            else:
+                new_limit = self._limit
+        else:
+            gradient = max(0.5, min(1.0, self.tolerance * self._long_latency / self._short_latency))
+            target = self._limit * gradient
+            if self._in_flight + 1 >= self._limit / 2:
+                # 同样只在额度用到一半以上时留出排队余量，空闲时上限不增长，saturated() 的背压仍然有效
+                target += math.sqrt(self._limit)
+            new_limit = (1 - self.smoothing) * self._limit + self.smoothing * target
+        self._limit = max(float(self.min_limit), min(float(self.max_limit), new_limit))
+
+    def _decrease(self):
+        # 一次拥塞会让当时在途的一轮调用都变慢或失败，每轮只减小一次，避免连续乘性减把上限压到底
+        if self._completions < self._hold_until:
+            return
+        self._hold_until = self._completions + math.ceil(self._limit)
+        self._limit = max(float(self.min_limit), self._limit * self.backoff)
+
+    def stats(self):
+        """
+        返回限制器当前状态
+
+        返回:
+            {"limit", "in_flight", "queue_depth", "short_latency", "long_latency", "samples", "errors"}
+        """
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "in_flight": self._in_flight,
+                "queue_depth": self._waiting,
+                "short_latency": self._short_latency,
+                "long_latency": self._long_latency,
+                "samples": self._samples,
+                "errors": self._errors,
+            }
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class _SlotHandle:
+    def __init__(self):
+        self.units = 0
+        self.excluded = 0.0  # 与并发无关的耗时（模型加载、提示词预填充），不计入延迟
+
+    def record(self, info):
+        """
+        从 Ollama 的响应元数据中读取生成 token 数与加载、预填充耗时（纳秒）
+
+        短输出、长提示词的阶段墙钟时间主要是预填充，直接除以 eval_count 会得到数倍于
+        正常水平的每 token 延迟并触发退避；扣除这部分后剩下的是解码与服务端排队时间。
+        """
+        self.units = info.get("eval_count") or 1
+        self.excluded = seconds(info, "load_duration", "prompt_eval_duration")
+
+    def latency(self, start):
+        elapsed = max(0.0, time.perf_counter() - start - self.excluded)
+        return elapsed / max(1, self.units)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(base_url="http://localhost:11434", **kwargs):
+    """
+    获取某个 Ollama 服务共享的限制器，同一地址的所有调用共用一个实例
+
+    参数:
+        base_url: Ollama服务地址
+        kwargs: 首次创建时传给 AdaptiveLimiter 的参数
+
+    返回:
+        AdaptiveLimiter
+    """
+    key = (base_url or "http://localhost:11434").rstrip("/")
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = AdaptiveLimiter(**kwargs)
+        return _limiters[key]
+
+
+class _ConnectionAbort:
+    """
+    记录请求使用的套接字，调用时 shutdown 以中断阻塞中的读取
+
+    关闭 httpx 客户端不会唤醒另一个线程中阻塞的读取，因此通过 httpcore 的 trace 扩展
+    取得新建连接的套接字，直接 shutdown。
+    """
+
+    def __init__(self):
+        self.fired = False
+        self._lock = threading.Lock()
+        self._sockets = []
+
+    def attach(self, request):
+        # httpx 的 request 事件钩子：在请求发送前挂上 trace 回调
+        previous = request.extensions.get("trace")
+
+        def trace(event_name, info):
+            if previous is not None:
+                previous(event_name, info)
+            if event_name == "connection.connect_tcp.complete":
+                sock = info["return_value"].get_extra_info("socket")
+                if sock is not None:
+                    self._add(sock)
+
+        request.extensions = {**request.extensions, "trace": trace}
+
+    def _add(self, sock):
+        with self._lock:
+            self._sockets.append(sock)
+            fired = self.fired
+        if fired:
+            _shutdown(sock)
+
+    def __call__(self):
+        with self._lock:
+            self.fired = True
+            sockets = list(self._sockets)
+        for sock in sockets:
+            _shutdown(sock)
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+if ChatOllama is not None:
+
+    class LimitedChatOllama(ChatOllama):
+        """
+        经过 AdaptiveLimiter 的 ChatOllama，所有调用共享同一 Ollama 服务的并发额度
+        """
+
+        limiter: Any = None
+
+        def _get_limiter(self):
+            return self.limiter or get_limiter(self.base_url)
+
+        def _slot(self):
+            deadline = current_deadline()
+            return self._get_limiter().slot(None if deadline is None else deadline.remaining())
+
+        def _aslot(self):
+            deadline = current_deadline()
+            return self._get_limiter().aslot(None if deadline is None else deadline.remaining())
+
+        def _create_chat_stream(self, messages, stop=None, **kwargs):
+            deadline = current_deadline()
+            if deadline is None or not deadline.bounded():
+                # 不限时的调用复用共享客户端的连接
+                yield from super()._create_chat_stream(messages, stop, **kwargs)
+                return
+
+            # 限时或可被取消时为本次调用单独创建客户端：超时或被取消时立即断开连接（包括仍在预填充、
+            # 尚未返回任何内容的请求），Ollama 随即停止生成，并发额度也随之释放
+            deadline.check()
+            params = self._chat_params(messages, stop, **kwargs)
+            params["stream"] = True
+            abort = _ConnectionAbort()
+            client = self._deadline_client(deadline.remaining(), abort)
+            unregister = deadline.on_cancel(abort)
+            # 整个调用（而不只是单次读取）不超过剩余时间
+            remaining = deadline.remaining()
+            timer = None
+            if remaining is not None:
+                timer = threading.Timer(remaining, abort)
+                timer.daemon = True
+                timer.start()
+            stream = None
+            try:
+                stream = client.chat(**params)
+                for part in stream:
+                    yield part
+                    if not part.get("done"):
+                        deadline.check()
+            except Exception:
+                if abort.fired or deadline.expired():
+                    raise DeadlineExceeded("Ollama请求已取消" if deadline.cancelled() else "Ollama请求已超时") from None
+                raise
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                unregister()
+                if stream is not None:
+                    stream.close()
+                client.close()
+
+        def _deadline_client(self, timeout, abort):
+            # 与 ChatOllama._set_clients 相同地处理 base_url 中的认证信息和 sync_client_kwargs
+            host = self.base_url
+            client_kwargs = dict(self.client_kwargs or {})
+            if parse_url_with_auth is not None:
+                host, auth_headers = parse_url_with_auth(self.base_url)
+                merge_auth_headers(client_kwargs, auth_headers)
+            client_kwargs.update(getattr(self, "sync_client_kwargs", None) or {})
+            client_kwargs["timeout"] = timeout
+            hooks = dict(client_kwargs.get("event_hooks") or {})
+            hooks["request"] = list(hooks.get("request", [])) + [abort.attach]
+            client_kwargs["event_hooks"] = hooks
+            return Client(host=host, **client_kwargs)
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            with self._slot() as handle:
+                result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                handle.record(chat_result_metadata(result))
+            return result
+
+        def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+            with self._slot() as handle:
+                for chunk in super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    handle.units += 1
+                    if chunk.generation_info and chunk.generation_info.get("eval_count"):
+                        # 最后一块带有完整的元数据
+                        handle.record(chunk.generation_info)
+                    yield chunk
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            async with self._aslot() as handle:
+                result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                handle.record(chat_result_metadata(result))
+            return result
+
+        async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+            async with self._aslot() as handle:
+                async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    handle.units += 1
+                    if chunk.generation_info and chunk.generation_info.get("eval_count"):
+                        # 最后一块带有完整的元数据
+                        handle.record(chunk.generation_info)
+                    yield chunk
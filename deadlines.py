@@ -0,0 +1,277 @@
+# deadlines.py
+# 截止时间、取消与对冲请求
+#
+# - Deadline: 整体/阶段截止时间，同时作为取消标记；通过 contextvars 传递给当前线程中的 Ollama 调用
+# - LatencyTracker: 记录每个阶段的耗时，提供 p95 作为对冲请求的触发阈值
+# - hedged_call: 主请求慢于 p95 时向第二个端点发送重复请求，取先完成的结果并取消另一个
+# - await_deadline / ahedged_call: 供 asyncio 协程使用的版本，超时或落败时直接取消任务
+
+import asyncio
+import contextvars
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+
+class DeadlineExceeded(TimeoutError):
+    """超过截止时间或请求被取消"""
+
+
+class Deadline:
+    """
+    截止时间
+
+    参数:
+        seconds: 距离截止的秒数，None 表示不限时
+        parent: 上级截止时间，实际截止取两者中较早的一个；上级取消时本截止也视为已取消
+        cancellable: 是否会在请求进行中被取消（如对冲请求的分支）
+    """
+
+    def __init__(self, seconds=None, parent=None, cancellable=False):
+        self._expires_at = None if seconds is None else time.monotonic() + seconds
+        self._parent = parent
+        self._cancellable = cancellable
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def remaining(self):
+        """剩余秒数，不限时返回 None"""
+        values = []
+        if self._expires_at is not None:
+            values.append(self._expires_at - time.monotonic())
+        if self._parent is not None:
+            parent_remaining = self._parent.remaining()
+            if parent_remaining is not None:
+                values.append(parent_remaining)
+        return max(0.0, min(values)) if values else None
+
+    def bounded(self):
+        """是否限时或会被取消；否则进行中的请求不需要为它提前中断"""
+        return (self._expires_at is not None or self._cancellable
+                or (self._parent is not None and self._parent.bounded()))
+
+    def cancel(self):
+        """取消：通过 on_cancel 注册的回调立即中止正在进行的请求"""
+        with self._lock:
+            self._cancelled.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback):
+        """
+        注册在本截止时间或任一上级被取消时调用的回调（已取消时立即调用）
+
+        返回:
+            注销回调的函数
+        """
+        registered = []
+        deadline = self
+        while deadline is not None:
+            with deadline._lock:
+                if deadline._cancelled.is_set():
+                    break
+                deadline._callbacks.append(callback)
+                registered.append(deadline)
+            deadline = deadline._parent
+        else:
+            return lambda: self._remove_callback(callback, registered)
+        self._remove_callback(callback, registered)
+        callback()
+        return lambda: None
+
+    @staticmethod
+    def _remove_callback(callback, registered):
+        for deadline in registered:
+            with deadline._lock:
+                if callback in deadline._callbacks:
+                    deadline._callbacks.remove(callback)
+
+    def cancelled(self):
+        return self._cancelled.is_set() or (self._parent is not None and self._parent.cancelled())
+
+    def expired(self):
+        """是否已超时或已取消"""
+        remaining = self.remaining()
+        return self.cancelled() or (remaining is not None and remaining <= 0)
+
+    def check(self, stage=None):
+        """已超时或已取消时抛出 DeadlineExceeded"""
+        if self.expired():
+            reason = "已取消" if self.cancelled() else "已超时"
+            raise DeadlineExceeded(f"{stage or '请求'}{reason}")
+
+    def child(self, seconds=None, cancellable=False):
+        """创建不晚于当前截止时间的子截止时间"""
+        return Deadline(seconds, parent=self, cancellable=cancellable)
+
+
+_current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+def current_deadline():
+    """返回当前上下文中的截止时间，没有则为 None"""
+    return _current_deadline.get()
+
+
+@contextmanager
+def deadline_scope(deadline):
+    """在此范围内发起的 Ollama 调用受 deadline 约束"""
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+class LatencyTracker:
+    """
+    按阶段记录最近的耗时
+
+    参数:
+        window: 每个阶段保留的样本数
+        min_samples: 样本数不足时不给出 p95
+    """
+
+    def __init__(self, window=100, min_samples=5):
+        self.min_samples = min_samples
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self._samples[stage].append(seconds)
+
+    def percentile(self, stage, q=0.95):
+        """返回阶段耗时的分位数，样本不足时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples[stage])
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def hedged_call(primary, secondary, hedge_after, deadline=None):
+    """
+    对冲请求
+
+    先执行 primary；若 hedge_after 秒内未完成，再执行 secondary，返回先成功的结果，
+    并取消另一个请求（其截止时间被取消，正在进行的 Ollama 调用随即中止）。
+
+    参数:
+        primary: 可调用对象，接收一个 Deadline 参数
+        secondary: 可调用对象，接收一个 Deadline 参数
+        hedge_after: 触发对冲的等待秒数
+        deadline: 整体截止时间（可选）
+
+    返回:
+        先成功完成的结果
+    """
+    deadline = deadline or Deadline()
+    branches = [deadline.child(cancellable=True), deadline.child(cancellable=True)]
+    pool = ThreadPoolExecutor(max_workers=2)
+
+    def run(func, branch_deadline):
+        with deadline_scope(branch_deadline):
+            return func(branch_deadline)
+
+    try:
+        futures = {pool.submit(contextvars.copy_context().run, run, primary, branches[0]): 0}
+        done, _ = wait(futures, timeout=hedge_after)
+        if not done:
+            futures[pool.submit(contextvars.copy_context().run, run, secondary, branches[1])] = 1
+
+        errors = []
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=deadline.remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded("对冲请求已超时")
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                # 取消仍在进行的另一个请求
+                for other in pending:
+                    branches[futures[other]].cancel()
+                return result
+        raise errors[0]
+    finally:
+        for branch in branches:
+            branch.cancel()
+        pool.shutdown(wait=False)
+
+
+async def await_deadline(awaitable, deadline, stage=None):
+    """
+    在截止时间内等待协程完成，超时则取消该协程（进行中的Ollama请求随即断开）
+
+    参数:
+        awaitable: 协程
+        deadline: Deadline
+        stage: 阶段名称，用于错误信息
+
+    返回:
+        协程的结果
+    """
+    try:
+        deadline.check(stage)
+    except DeadlineExceeded:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise
+    try:
+        return await asyncio.wait_for(awaitable, deadline.remaining())
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"{stage or '请求'}已超时") from None
+
+
+async def ahedged_call(primary, secondary, hedge_after, deadline=None):
+    """
+    hedged_call 的协程版本
+
+    参数:
+        primary: 接收一个 Deadline 参数并返回协程的可调用对象
+        secondary: 接收一个 Deadline 参数并返回协程的可调用对象
+        hedge_after: 触发对冲的等待秒数
+        deadline: 整体截止时间（可选）
+
+    返回:
+        先成功完成的结果；另一个请求的任务被取消
+    """
+    deadline = deadline or Deadline()
+    branches = [deadline.child(cancellable=True), deadline.child(cancellable=True)]
+
+    async def run(func, branch_deadline):
+        with deadline_scope(branch_deadline):
+            return await func(branch_deadline)
+
+    tasks = {asyncio.ensure_future(run(primary, branches[0]))}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            tasks.add(asyncio.ensure_future(run(secondary, branches[1])))
+
+        errors = []
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=deadline.remaining(),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded("对冲请求已超时")
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                    continue
+                return task.result()
+        raise errors[0]
+    finally:
+        for task in tasks:
+            task.cancel()
+        for branch in branches:
+            branch.cancel()
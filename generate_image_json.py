@@ -1,97 +1,191 @@
-import pandas as pd
+# generate_image_json.py
+# 图片描述表格转 JSON / JSON Lines 工具
+#
+# 支持 Excel(.xlsx)、CSV、Parquet 输入，按块流式读取，内存占用与表格大小无关：
+# - Excel 使用 openpyxl 的 read_only 模式逐行读取
+# - 列名只识别一次，空值在每个数据块上批量过滤
+# - 结果逐块写入，.jsonl 输出为每行一个对象，.json 输出为与 sample_images.json 相同的列表格式
+#
+# 用法:
+#     python generate_image_json.py image_descriptions_api.xlsx -o sample_images.jsonl
+
+import argparse
 import json
 import os
 
-# 定义Excel文件路径
-excel_file = r'c:\Users\16846\Desktop\保密\PDF2WEB_V1\image_descriptions_api.xlsx'
-# 定义输出JSON文件路径
-output_json = r'c:\Users\16846\Desktop\保密\PDF2WEB_V1\sample_images.json'
-
-try:
-    # 检查文件是否存在
-    if not os.path.exists(excel_file):
-        raise FileNotFoundError(f"Excel文件不存在: {excel_file}")
-    
-    print(f"开始读取Excel文件: {excel_file}")
-    
-    # 尝试不同的方法读取Excel文件
-    try:
-        df = pd.read_excel(excel_file, engine='openpyxl')
-    except:
-        df = pd.read_excel(excel_file)
-    
-    print(f"成功读取Excel文件，共 {len(df)} 行数据")
-    print(f"Excel文件中的列: {list(df.columns)}")
-    
-    # 尝试查找可能的列名变体
-    columns = [col.strip() for col in df.columns]
-    print(f"清理后的列名: {columns}")
-    
-    # 定义可能的列名变体
+import pandas as pd
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+def detect_columns(columns):
+    """
+    识别图片路径列和描述列
+
+    参数:
+        columns: 表头列名列表
+
+    返回:
+        (路径列名, 描述列名)，无法识别时为 None
+    """
+    cleaned = [str(col).strip() for col in columns]
     path_column = None
     desc_column = None
-    
+
     # 查找Image Path相关的列
-    for col in columns:
+    for original, col in zip(columns, cleaned):
         if 'path' in col.lower() or 'url' in col.lower() or '图片' in col:
-            path_column = df.columns[columns.index(col)]
+            path_column = original
             break
-    
+
     # 查找Description相关的列
-    for col in columns:
+    for original, col in zip(columns, cleaned):
         if 'desc' in col.lower() or '描述' in col or '说明' in col:
-            desc_column = df.columns[columns.index(col)]
+            desc_column = original
             break
-    
+
     # 如果找不到合适的列，尝试使用前两列
     if not path_column and not desc_column and len(columns) >= 2:
         print("警告: 无法识别标准列名，尝试使用前两列")
-        path_column = df.columns[0]
-        desc_column = df.columns[1]
-    
-    print(f"使用的路径列: {path_column}")
-    print(f"使用的描述列: {desc_column}")
-    
-    # 创建sample_images列表
-    sample_images = []
-    
-    # 遍历Excel数据，构建字典列表
-    for index, row in df.iterrows():
-        try:
-            path_value = row[path_column]
-            desc_value = row[desc_column]
-            
-            # 检查行数据是否为空
-            if pd.notna(path_value) and pd.notna(desc_value):
-                image_entry = {
-                    "url": str(path_value).strip(),
-                    "caption": str(desc_value).strip()
-                }
-                sample_images.append(image_entry)
-                # 打印前几行数据作为示例
-                if index < 3:
-                    print(f"示例数据 {index+1}: {image_entry}")
-        except Exception as e:
-            print(f"处理行 {index+1} 时出错: {str(e)}")
-    
-    # 生成JSON格式的内容 - 注意这里直接生成sample_images列表
-    # 而不是包装在字典中，以符合用户要求的格式
-    
-    # 将数据写入JSON文件
-    with open(output_json, 'w', encoding='utf-8') as f:
-        json.dump(sample_images, f, ensure_ascii=False, indent=4)
-    
-    print(f"成功生成JSON文件: {output_json}")
-    print(f"共处理了 {len(sample_images)} 条图片数据")
-    
-    # 读取生成的文件并显示前100个字符以验证格式
-    with open(output_json, 'r', encoding='utf-8') as f:
-        preview = f.read(100)
-        print(f"生成的JSON文件预览: {preview}...")
-    
-except FileNotFoundError as e:
-    print(f"错误: {str(e)}")
-except Exception as e:
-    print(f"处理过程中发生错误: {str(e)}")
-    import traceback
-    traceback.print_exc()
\ No newline at end of file
+        path_column, desc_column = columns[0], columns[1]
+
+    return path_column, desc_column
+
+
+def _iter_excel_chunks(input_path, chunk_size):
+    """使用 openpyxl read_only 模式按块读取第一个工作表"""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(input_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = [str(col) if col is not None else f"Unnamed: {i}" for i, col in enumerate(header)]
+        buffer = []
+        for row in rows:
+            buffer.append(row)
+            if len(buffer) >= chunk_size:
+                yield pd.DataFrame.from_records(buffer, columns=header)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame.from_records(buffer, columns=header)
+    finally:
+        workbook.close()
+
+
+def _iter_parquet_chunks(input_path, chunk_size):
+    """使用 pyarrow 按记录批次读取 Parquet"""
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(input_path)
+    for batch in parquet_file.iter_batches(batch_size=chunk_size):
+        yield batch.to_pandas()
+
+
+def iter_chunks(input_path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    按块读取表格文件
+
+    参数:
+        input_path: .xlsx / .csv / .parquet 文件路径
+        chunk_size: 每块行数
+
+    返回:
+        DataFrame 生成器
+    """
+    ext = os.path.splitext(input_path)[1].lower()
+    if ext in ('.xlsx', '.xlsm'):
+        return _iter_excel_chunks(input_path, chunk_size)
+    if ext == '.csv':
+        return pd.read_csv(input_path, chunksize=chunk_size, dtype=str)
+    if ext == '.parquet':
+        return _iter_parquet_chunks(input_path, chunk_size)
+    raise ValueError(f"不支持的文件格式: {ext}")
+
+
+def _clean_chunk(chunk, path_column, desc_column):
+    """批量过滤空值并去除首尾空白，返回 url/caption 两列"""
+    paths = chunk[path_column]
+    descs = chunk[desc_column]
+    mask = paths.notna() & descs.notna()
+    paths = paths[mask].astype(str).str.strip()
+    descs = descs[mask].astype(str).str.strip()
+    keep = (paths != "") & (descs != "")
+    return pd.DataFrame({"url": paths[keep], "caption": descs[keep]})
+
+
+def convert(input_path, output_path, chunk_size=DEFAULT_CHUNK_SIZE, output_format=None):
+    """
+    将图片描述表格转换为 JSON Lines 或 JSON 列表
+
+    参数:
+        input_path: 输入文件（.xlsx / .csv / .parquet）
+        output_path: 输出文件
+        chunk_size: 每块行数
+        output_format: "jsonl" 或 "json"，默认根据输出文件扩展名判断
+
+    返回:
+        写入的记录数
+    """
+    if not os.path.exists(input_path):
+        raise FileNotFoundError(f"输入文件不存在: {input_path}")
+    if output_format is None:
+        output_format = "json" if output_path.lower().endswith(".json") else "jsonl"
+
+    print(f"开始读取文件: {input_path}")
+
+    path_column = desc_column = None
+    count = 0
+    with open(output_path, 'w', encoding='utf-8') as f:
+        if output_format == "json":
+            f.write("[")
+        for chunk in iter_chunks(input_path, chunk_size):
+            if path_column is None:
+                print(f"文件中的列: {list(chunk.columns)}")
+                path_column, desc_column = detect_columns(list(chunk.columns))
+                if path_column is None or desc_column is None:
+                    raise ValueError(f"无法识别路径列或描述列: {list(chunk.columns)}")
+                print(f"使用的路径列: {path_column}")
+                print(f"使用的描述列: {desc_column}")
+
+            records = _clean_chunk(chunk, path_column, desc_column)
+            if records.empty:
+                continue
+            for record in records.itertuples(index=False):
+                # 逐行用 json.dumps 序列化，不用 DataFrame.to_json（会把 "/" 转义为 "\\/"）
+                row = json.dumps({"url": record.url, "caption": record.caption}, ensure_ascii=False)
+                if output_format == "json":
+                    f.write(",\n    " if count else "\n    ")
+                    f.write(row)
+                else:
+                    f.write(row + "\n")
+                count += 1
+        if output_format == "json":
+            f.write("\n]\n" if count else "]\n")
+
+    print(f"成功生成文件: {output_path}")
+    print(f"共处理了 {count} 条图片数据")
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="将图片描述表格转换为 JSON / JSON Lines")
+    parser.add_argument("input", nargs="?", default="image_descriptions_api.xlsx",
+                        help="输入文件（.xlsx / .csv / .parquet）")
+    parser.add_argument("-o", "--output", default="sample_images.jsonl",
+                        help="输出文件，扩展名为 .json 时输出列表格式，否则输出 JSON Lines")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="每块读取的行数")
+    parser.add_argument("--format", choices=("jsonl", "json"), help="输出格式，默认根据扩展名判断")
+    args = parser.parse_args()
+
+    try:
+        convert(args.input, args.output, chunk_size=args.chunk_size, output_format=args.format)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"错误: {str(e)}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
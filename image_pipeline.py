@@ -0,0 +1,325 @@
+# image_pipeline.py
+# 流水线式图片描述：扫描 → 读取/解码/缩放/编码（进程池）→ 推理（HTTP线程池）→ 写入目录/Excel
+#
+# 各阶段之间用有界队列连接，下游变慢时上游在 put 上阻塞：
+# 同时驻留在内存中的图片数由队列长度和在途任务数决定，与文件夹大小无关。
+# 编码在进程池中进行，与模型推理重叠；推理线程的实际在途请求数仍由共享的并发限制器控制。
+# 每个阶段统计处理数量、忙碌时间和等待下游的时间，结束时打印利用率。
+#
+# 用法:
+#     pipeline = ImageCaptionPipeline(model="qwen2.5vl:7b", batch_size=4)
+#     pipeline.run("img", excel_path="image_descriptions_api.xlsx", catalog_path="sample_images.jsonl")
+
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from Image_Recognition import caption_encoded_images, encode_image
+from stage_metrics import stage_scope
+
+# 所有按文件夹读取图片的入口（PPTGenerator.load_images_from_folder、batch_runner、图片描述）共用
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'}
+# 从文件夹为一份PPT加载的默认最大图片数
+DEFAULT_MAX_IMAGES = 10
+
+_DONE = object()
+
+
+def iter_image_files(folder):
+    """
+    逐个返回文件夹中的图片路径（不预先列出整个文件夹）
+    """
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                yield entry.path
+
+
+def list_image_files(folder, max_images=None):
+    """
+    返回文件夹中按文件名排序的图片路径
+
+    参数:
+        folder: 图片文件夹
+        max_images: 最多返回的图片数，None 表示不限制
+    """
+    paths = sorted(iter_image_files(folder))
+    return paths if max_images is None else paths[:max_images]
+
+
+def _encode_timed(image_path, max_side):
+    # 在子进程中执行，返回 (base64数据, 错误信息, 耗时)
+    start = time.perf_counter()
+    try:
+        return encode_image(image_path, max_side), None, time.perf_counter() - start
+    except Exception as e:
+        return None, f"❌ 处理 {image_path} 时发生未知错误: {str(e)}", time.perf_counter() - start
+
+
+class StageStats:
+    """
+    单个阶段的处理数量、忙碌时间与等待下游（队列已满）的时间
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items=0, busy=0.0, blocked=0.0):
+        with self._lock:
+            self.items += items
+            self.busy_seconds += busy
+            self.blocked_seconds += blocked
+
+    def report(self, elapsed):
+        """
+        返回:
+            {"stage", "workers", "items", "busy_seconds", "blocked_seconds", "utilization"}
+            utilization 为忙碌时间占 (工作者数 × 总耗时) 的比例
+        """
+        with self._lock:
+            capacity = self.workers * elapsed
+            return {
+                "stage": self.name,
+                "workers": self.workers,
+                "items": self.items,
+                "busy_seconds": self.busy_seconds,
+                "blocked_seconds": self.blocked_seconds,
+                "utilization": self.busy_seconds / capacity if capacity > 0 else 0.0,
+            }
+
+
+class ImageCaptionPipeline:
+    """
+    有界队列连接的图片描述流水线
+
+    参数:
+        model: Ollama 视觉模型名称
+        batch_size: 每次请求最多合并的图片数（见 caption_encoded_images）
+        encode_workers: 读取/编码进程数，默认 CPU 核数
+        inference_workers: 推理线程数
+        queue_size: 各阶段之间队列的长度
+        max_side: 发送前把图片长边缩小到该像素数（需要 Pillow）
+        keep_alive / residency / limiter / timeout: 与 analyze_image_with_ollama_api 相同
+    """
+
+    def __init__(self, model='llava', batch_size=1, encode_workers=None, inference_workers=4, queue_size=16,
+                 max_side=None, keep_alive=None, residency=None, limiter=None, timeout=None):
+        self.model = model
+        self.batch_size = max(1, batch_size)
+        self.encode_workers = encode_workers or os.cpu_count() or 1
+        self.inference_workers = inference_workers
+        self.queue_size = queue_size
+        self.max_side = max_side
+        self.keep_alive = keep_alive
+        self.residency = residency
+        self.limiter = limiter
+        self.timeout = timeout
+        self.stats = {}
+
+    def run(self, folder, excel_path=None, catalog_path=None):
+        """
+        处理文件夹中的所有图片
+
+        参数:
+            folder: 图片文件夹
+            excel_path: 输出Excel（列为 Image Path、Image Name、Description），写入时逐行流式保存
+            catalog_path: 输出JSON Lines目录（每行 {"url", "caption"}，可直接作为 PPTGenerator 的图片列表）
+
+        返回:
+            {"images": 处理的图片数, "elapsed": 总耗时, "stages": [各阶段的 StageStats.report()]}
+        """
+        self.stats = {
+            "scan": StageStats("scan", 1),
+            "encode": StageStats("encode", self.encode_workers),
+            "inference": StageStats("inference", self.inference_workers),
+            "sink": StageStats("sink", 1),
+        }
+        paths = queue.Queue(self.queue_size)
+        encoded = queue.Queue(self.queue_size)
+        results = queue.Queue(self.queue_size)
+        errors = []
+
+        # 各线程在对应的阶段中运行，剖析（profiling.py）时调用栈按阶段归类
+        threads = [threading.Thread(target=self._guard, args=("scan", self._scan, errors, folder, paths),
+                                    daemon=True),
+                   threading.Thread(target=self._guard, args=("encode", self._encode, errors, paths, encoded),
+                                    daemon=True)]
+        threads += [threading.Thread(target=self._guard, args=("inference", self._infer, errors, encoded, results),
+                                     daemon=True)
+                    for _ in range(self.inference_workers)]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        with stage_scope("sink"):
+            count = self._sink(results, excel_path, catalog_path)
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        if errors:
+            raise errors[0]
+        return {"images": count, "elapsed": elapsed,
+                "stages": [stats.report(elapsed) for stats in self.stats.values()]}
+
+    def print_report(self, summary):
+        """打印 run() 返回的各阶段利用率"""
+        print(f"⏱️  共处理 {summary['images']} 张图片，耗时 {summary['elapsed']:.2f} 秒")
+        for stage in summary["stages"]:
+            print(f"📊 {stage['stage']}: {stage['items']} 项，{stage['workers']} 个工作者，"
+                  f"利用率 {stage['utilization']:.0%}，等待下游 {stage['blocked_seconds']:.2f} 秒")
+
+    @staticmethod
+    def _guard(stage, target, errors, *args):
+        try:
+            with stage_scope(stage):
+                target(*args)
+        except BaseException as e:
+            errors.append(e)
+
+    @staticmethod
+    def _put(q, item, stats):
+        start = time.perf_counter()
+        q.put(item)
+        stats.add(blocked=time.perf_counter() - start)
+
+    def _scan(self, folder, paths):
+        stats = self.stats["scan"]
+        try:
+            files = iter_image_files(folder)
+            while True:
+                start = time.perf_counter()
+                path = next(files, None)
+                stats.add(busy=time.perf_counter() - start)
+                if path is None:
+                    break
+                stats.add(items=1)
+                self._put(paths, path, stats)
+        finally:
+            paths.put(_DONE)
+
+    def _encode(self, paths, encoded):
+        stats = self.stats["encode"]
+        max_pending = self.encode_workers * 2
+        pending = {}
+
+        def forward(futures):
+            for future in futures:
+                path = pending.pop(future)
+                try:
+                    data, error, seconds = future.result()
+                except Exception as e:
+                    data, error, seconds = None, f"❌ 处理 {path} 时发生未知错误: {str(e)}", 0.0
+                stats.add(items=1, busy=seconds)
+                self._put(encoded, (path, data, error), stats)
+
+        try:
+            # 此时扫描、推理线程（以及剖析时的采样线程）已在运行，fork 多线程进程可能让子进程
+            # 卡在 fork 时被其他线程持有的锁上，因此用 spawn 启动全新的解释器
+            with ProcessPoolExecutor(max_workers=self.encode_workers,
+                                     mp_context=multiprocessing.get_context("spawn")) as pool:
+                scanning = True
+                while scanning or pending:
+                    # 有空闲进程且扫描阶段有新文件时提交，否则等待已提交的编码完成
+                    if scanning and len(pending) < max_pending:
+                        try:
+                            path = paths.get(timeout=0.05 if pending else None)
+                        except queue.Empty:
+                            path = None
+                        if path is _DONE:
+                            scanning = False
+                        elif path is not None:
+                            pending[pool.submit(_encode_timed, path, self.max_side)] = path
+                    if pending:
+                        done, _ = wait(pending, timeout=0 if scanning and len(pending) < max_pending else None,
+                                       return_when=FIRST_COMPLETED)
+                        forward(done)
+        finally:
+            for _ in range(self.inference_workers):
+                encoded.put(_DONE)
+
+    def _infer(self, encoded, results):
+        stats = self.stats["inference"]
+        finished = False
+        try:
+            while not finished:
+                item = encoded.get()
+                if item is _DONE:
+                    break
+                # 队列中已有的图片合并为一次请求，不为凑满批次而等待
+                batch = [item]
+                while len(batch) < self.batch_size:
+                    try:
+                        item = encoded.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _DONE:
+                        finished = True
+                        break
+                    batch.append(item)
+
+                start = time.perf_counter()
+                rows = self._caption(batch)
+                stats.add(items=len(batch), busy=time.perf_counter() - start)
+                for row in rows:
+                    self._put(results, row, stats)
+        finally:
+            results.put(_DONE)
+
+    def _caption(self, batch):
+        descriptions = {path: error for path, data, error in batch if data is None}
+        ready = [(path, data) for path, data, error in batch if data is not None]
+        if ready:
+            captions = caption_encoded_images([path for path, _ in ready], [data for _, data in ready],
+                                              model=self.model, keep_alive=self.keep_alive,
+                                              residency=self.residency, limiter=self.limiter, timeout=self.timeout)
+            descriptions.update(zip([path for path, _ in ready], captions))
+        return [(path, descriptions[path]) for path, _, _ in batch]
+
+    def _sink(self, results, excel_path, catalog_path):
+        stats = self.stats["sink"]
+        workbook = sheet = catalog = None
+        if excel_path:
+            from openpyxl import Workbook
+
+            # write_only 模式逐行写入临时文件，不在内存中保留整张表
+            workbook = Workbook(write_only=True)
+            sheet = workbook.create_sheet()
+            sheet.append(['Image Path', 'Image Name', 'Description'])
+        if catalog_path:
+            catalog = open(catalog_path, "w", encoding="utf-8")
+
+        count = 0
+        remaining = self.inference_workers
+        try:
+            while remaining:
+                row = results.get()
+                if row is _DONE:
+                    remaining -= 1
+                    continue
+                start = time.perf_counter()
+                path, description = row
+                full_path = os.path.abspath(path)
+                count += 1
+                print(f"  ({count}) 已完成: {os.path.basename(path)}")
+                if sheet is not None:
+                    sheet.append([full_path, os.path.basename(path), description])
+                if catalog is not None:
+                    catalog.write(json.dumps({"url": full_path, "caption": description}, ensure_ascii=False) + "\n")
+                    catalog.flush()
+                stats.add(items=1, busy=time.perf_counter() - start)
+        finally:
+            if catalog is not None:
+                catalog.close()
+        if workbook is not None:
+            workbook.save(excel_path)
+        return count
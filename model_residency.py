@@ -0,0 +1,187 @@
+# model_residency.py
+# Ollama 模型常驻管理：预热、keep_alive 控制、按模型分组调度、加载/推理耗时统计
+#
+# 文本流程使用 qwen2.5:7b，图片识别使用 qwen2.5vl:7b。两者在同一个 Ollama 节点上
+# 交替调用时会互相挤出显存，每次换模型都要重新加载。这里集中处理：
+#   1. 启动时发送预热请求，并为每个模型设置 keep_alive
+#   2. 多个模型的任务排队时按模型分组执行，先跑已加载的模型，减少换模型次数
+#   3. 分别统计模型加载耗时与推理耗时
+
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+try:
+    from langchain_core.callbacks import BaseCallbackHandler
+except ImportError:  # 仅使用 HTTP 接口（如 Image_Recognition.py）时不需要 langchain
+    BaseCallbackHandler = object
+
+from ollama_metadata import llm_result_metadata, seconds
+
+# 已驻留的模型 load_duration 只有几毫秒，超过该秒数才计为一次加载
+_LOAD_THRESHOLD = 0.5
+
+
+class ModelResidencyManager:
+    """
+    管理 Ollama 模型的驻留状态
+
+    参数:
+        base_url: Ollama服务地址
+        keep_alive: 每个模型的 keep_alive 设置，如 {"qwen2.5:7b": "30m"}
+        default_keep_alive: 未单独设置的模型使用的 keep_alive
+    """
+
+    def __init__(self, base_url="http://localhost:11434", keep_alive=None, default_keep_alive="30m"):
+        self.base_url = base_url.rstrip("/")
+        self.keep_alive = dict(keep_alive or {})
+        self.default_keep_alive = default_keep_alive
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {
+            "calls": 0,
+            "loads": 0,
+            "load_seconds": 0.0,
+            "inference_seconds": 0.0,
+        })
+
+    def keep_alive_for(self, model):
+        """返回指定模型的 keep_alive 设置"""
+        return self.keep_alive.get(model, self.default_keep_alive)
+
+    def loaded_models(self):
+        """
+        查询当前已加载到内存中的模型
+
+        返回:
+            模型名称列表，查询失败时返回空列表
+        """
+        try:
+            response = requests.get(f"{self.base_url}/api/ps", timeout=5)
+            response.raise_for_status()
+            return [m.get("name") or m.get("model") for m in response.json().get("models", [])]
+        except Exception as e:
+            print(f"⚠️  查询已加载模型失败: {str(e)}")
+            return []
+
+    def warm_up(self, models, timeout=300):
+        """
+        预热模型：发送不含 prompt 的请求，让 Ollama 提前加载模型并按 keep_alive 保持驻留
+
+        参数:
+            models: 模型名称列表
+            timeout: 每个模型的最长等待秒数（含加载时间）
+
+        返回:
+            {模型名称: 加载耗时(秒)}，失败的模型不在结果中
+        """
+        timings = {}
+        for model in models:
+            payload = {"model": model, "keep_alive": self.keep_alive_for(model)}
+            start = time.perf_counter()
+            try:
+                response = requests.post(f"{self.base_url}/api/generate", json=payload, timeout=timeout)
+                response.raise_for_status()
+            except Exception as e:
+                print(f"⚠️  预热模型 {model} 失败: {str(e)}")
+                continue
+            elapsed = time.perf_counter() - start
+            result = response.json()
+            # 模型已在内存中时 Ollama 不会重新加载，load_duration 接近 0
+            load_seconds = seconds(result, "load_duration") if "load_duration" in result else elapsed
+            if load_seconds > _LOAD_THRESHOLD:
+                with self._lock:
+                    stats = self._stats[model]
+                    stats["loads"] += 1
+                    stats["load_seconds"] += load_seconds
+            timings[model] = load_seconds
+            print(f"🔥 模型 {model} 已预热，耗时 {load_seconds:.2f} 秒 (keep_alive={payload['keep_alive']})")
+        return timings
+
+    def record(self, model, metadata):
+        """
+        记录一次调用的 Ollama 耗时信息
+
+        参数:
+            model: 模型名称
+            metadata: Ollama 响应中的耗时字段（load_duration、prompt_eval_duration、eval_duration 等）
+        """
+        if not metadata:
+            return
+        load_seconds = seconds(metadata, "load_duration")
+        inference_seconds = seconds(metadata, "prompt_eval_duration", "eval_duration")
+        with self._lock:
+            stats = self._stats[model]
+            stats["calls"] += 1
+            stats["inference_seconds"] += inference_seconds
+            if load_seconds > _LOAD_THRESHOLD:
+                stats["loads"] += 1
+                stats["load_seconds"] += load_seconds
+
+    def run_grouped(self, jobs, workers=1):
+        """
+        按模型分组执行任务，减少模型切换
+
+        已加载的模型优先执行，其余模型按首次出现的顺序执行；一个模型的任务全部完成后才开始下一个模型。
+
+        参数:
+            jobs: 任务列表 [(模型名称, 可调用对象), ...]
+            workers: 同一模型内并发执行的任务数，为 1 时按原有顺序逐个执行
+
+        返回:
+            与 jobs 顺序一致的结果列表
+        """
+        groups = OrderedDict()
+        for index, (model, func) in enumerate(jobs):
+            groups.setdefault(model, []).append((index, func))
+
+        loaded = set(self.loaded_models())
+        order = sorted(groups, key=lambda m: m not in loaded)
+
+        results = [None] * len(jobs)
+        for model in order:
+            group = groups[model]
+            if workers > 1 and len(group) > 1:
+                with ThreadPoolExecutor(max_workers=min(workers, len(group))) as pool:
+                    for (index, _), result in zip(group, pool.map(lambda item: item[1](), group)):
+                        results[index] = result
+            else:
+                for index, func in group:
+                    results[index] = func()
+        return results
+
+    def callback_handler(self, model):
+        """返回用于 ChatOllama 的回调，自动记录每次调用的耗时"""
+        return OllamaTimingCallback(self, model)
+
+    def report(self):
+        """
+        返回每个模型的耗时统计
+
+        返回:
+            {模型名称: {"calls", "loads", "load_seconds", "inference_seconds"}}
+        """
+        with self._lock:
+            return {model: dict(stats) for model, stats in self._stats.items()}
+
+    def print_report(self):
+        """打印加载与推理耗时统计"""
+        for model, stats in self.report().items():
+            print(f"📊 {model}: 调用 {stats['calls']} 次，加载 {stats['loads']} 次 "
+                  f"({stats['load_seconds']:.2f} 秒)，推理 {stats['inference_seconds']:.2f} 秒")
+
+
+class OllamaTimingCallback(BaseCallbackHandler):
+    """
+    langchain 回调：从 ChatOllama 的响应元数据中读取耗时字段并交给 ModelResidencyManager
+    """
+
+    def __init__(self, manager, model):
+        self.manager = manager
+        self.model = model
+
+    def on_llm_end(self, response, **kwargs):
+        for metadata in llm_result_metadata(response):
+            self.manager.record(self.model, metadata)
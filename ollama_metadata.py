@@ -0,0 +1,56 @@
+# ollama_metadata.py
+# 读取 Ollama 响应元数据的公共函数
+#
+# Ollama 在每次调用结束时返回 prompt_eval_count、prompt_eval_duration、eval_count、eval_duration、
+# load_duration、done_reason 等字段；langchain 把它们放在 generation_info 或 message.response_metadata 中。
+# 模型驻留统计（model_residency）、阶段统计（stage_metrics）与并发限制器（concurrency）都从这里读取。
+
+import math
+
+# Ollama 返回的耗时字段单位为纳秒
+_NS = 1e9
+
+
+def seconds(metadata, *fields):
+    """
+    返回若干耗时字段之和（秒），缺失的字段按 0 计
+
+    例: seconds(metadata, "prompt_eval_duration", "eval_duration")
+    """
+    return sum((metadata.get(field) or 0) for field in fields) / _NS
+
+
+def estimate_tokens(text):
+    """
+    粗略估计文本的 token 数：中日韩字符约每字 1 个 token，其余约每 4 个字符 1 个 token
+
+    流式调用被提前停止时 Ollama 不会返回 prompt_eval_count，用它补上提示词大小。
+    """
+    cjk = sum(1 for ch in text if "\u2e80" <= ch <= "\u9fff" or "\uf900" <= ch <= "\ufaff")
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def generation_metadata(generation):
+    """返回一个 langchain generation 的 Ollama 元数据，没有则为空字典"""
+    metadata = generation.generation_info
+    if not metadata and hasattr(generation, "message"):
+        metadata = generation.message.response_metadata
+    return metadata or {}
+
+
+def llm_result_metadata(response):
+    """
+    逐个返回回调 on_llm_end 收到的 LLMResult 中各 generation 的元数据
+    """
+    for generations in response.generations:
+        for generation in generations:
+            yield generation_metadata(generation)
+
+
+def chat_result_metadata(chat_result):
+    """返回 ChatResult 中第一个带 eval_count 的元数据，没有则为空字典"""
+    for generation in chat_result.generations:
+        metadata = generation_metadata(generation)
+        if metadata.get("eval_count"):
+            return metadata
+    return {}
@@ -4,12 +4,165 @@
 
 import os
 import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from textwrap import dedent
 import pandas as pd
-from langchain_ollama import ChatOllama
 from langchain.agents import initialize_agent, AgentType
 from langchain.tools import Tool
 from langchain_core.prompts import PromptTemplate
 from langchain.chains import LLMChain
+from model_residency import ModelResidencyManager
+from concurrency import LimitedChatOllama, get_limiter
+from deadlines import (Deadline, DeadlineExceeded, LatencyTracker, ahedged_call, await_deadline, deadline_scope,
+                       hedged_call)
+from stage_metrics import StageMetrics, StageMetricsCallback, stage_scope
+from singleflight import make_key, shared_single_flight
+from image_pipeline import DEFAULT_MAX_IMAGES, list_image_files
+from ollama_metadata import estimate_tokens
+import ppt_renderer
+
+_NO_FALLBACK = object()
+
+# 所有阶段共享的提示词前缀（系统说明 + 原始文本），必须逐字节一致才能命中 Ollama 的前缀缓存
+SHARED_PREFIX = (
+    "你是一名专业的PPT内容策划助手，以下所有任务都基于同一段原始文本完成。\n\n"
+    "=============== 原始文本 ===============\n"
+    "{text}\n"
+    "=============== 原始文本结束 ===============\n\n"
+)
+
+# 依赖提纲的阶段把提纲放在共享前缀之后、阶段指令之前
+OUTLINE_SECTION = "【结构提纲】\n{outline}\n\n"
+
+# 各阶段的输出预算：num_predict 上限、停止序列，json=True 表示输出一个JSON对象，对象闭合即停止生成
+STAGE_BUDGETS = {
+    "summary": {"num_predict": 128, "stop": ["\n\n"]},
+    "key_points": {"num_predict": 512},
+    "outline": {"num_predict": 1024},
+    "image_usage": {"num_predict": 192, "stop": ["\n\n\n"]},
+    "final_prompt": {"num_predict": 3072},
+    "slide_model": {"num_predict": 3072, "json": True},
+}
+
+# 旧的智能体调度方式下各阶段发送给智能体的指令（use_agent=True 时使用）
+AGENT_INPUTS = {
+    "outline": "请为以下文本生成提纲：\n{text}",
+    "image_usage": "请分析这张图片的用途：{image_json}",
+    "final_prompt": "请整合以下信息，生成PPT代码提示词：{final_input_json}",
+    "summary": "请用一句话总结文本：\n{text}",
+    "key_points": "请提取重点：\n{text}",
+}
+
+class _JsonObjectScanner:
+    """
+    逐块扫描流式输出，找到第一个JSON对象闭合的位置（忽略字符串中的括号）
+    """
+    
+    def __init__(self):
+        self.parts = []
+        self.depth = 0
+        self.started = self.in_string = self.escaped = False
+    
+    def feed(self, content):
+        """
+        追加一块输出
+        
+        返回:
+            对象已闭合时返回截至对象末尾的完整文本，否则返回 None
+        """
+        for i, ch in enumerate(content):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+                self.started = True
+            elif ch == "}" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.parts.append(content[:i + 1])
+                    return "".join(self.parts).strip()
+        self.parts.append(content)
+        return None
+    
+    def text(self):
+        return "".join(self.parts).strip()
+
+class _StreamUsage:
+    """
+    统计流式调用的块数与首块前后的耗时
+    """
+    
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first = None
+        self.count = 0
+    
+    def add(self):
+        if self.first is None:
+            self.first = time.perf_counter()
+        self.count += 1
+    
+    def metadata(self):
+        end = time.perf_counter()
+        first = self.first or end
+        return {
+            "eval_count": self.count,
+            "prompt_eval_duration": int((first - self.start) * 1e9),
+            "eval_duration": int((end - first) * 1e9),
+        }
+
+
+def read_json_object(chunks):
+    """
+    从流式输出中读取第一个完整的JSON对象，对象闭合后停止读取并关闭流
+    
+    参数:
+        chunks: 模型流式输出的消息块
+    
+    返回:
+        (文本, 用量, 是否在对象闭合时提前停止)
+        用量为 Ollama 元数据格式：eval_count 为已读取的块数，prompt_eval_duration 为收到第一块之前的时间
+        （预填充，含排队与模型加载），eval_duration 为之后的时间（纳秒）
+    """
+    scanner = _JsonObjectScanner()
+    usage = _StreamUsage()
+    try:
+        for chunk in chunks:
+            usage.add()
+            text = scanner.feed(chunk.content if hasattr(chunk, "content") else str(chunk))
+            if text is not None:
+                return text, usage.metadata(), True
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+    return scanner.text(), usage.metadata(), False
+
+async def aread_json_object(chunks):
+    """
+    read_json_object 的异步版本，chunks 为异步迭代器（如 ChatOllama.astream 的返回值）
+    """
+    scanner = _JsonObjectScanner()
+    usage = _StreamUsage()
+    try:
+        async for chunk in chunks:
+            usage.add()
+            text = scanner.feed(chunk.content if hasattr(chunk, "content") else str(chunk))
+            if text is not None:
+                return text, usage.metadata(), True
+    finally:
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+    return scanner.text(), usage.metadata(), False
 
 class PPTGenerator:
     """
@@ -17,7 +170,10 @@ class PPTGenerator:
     基于本地Ollama大模型，支持从文本和图片生成PPT代码提示词
     """
     
-    def __init__(self, model="qwen2.5:7b", temperature=0.3, base_url="http://localhost:11434"):
+    def __init__(self, model="qwen2.5:7b", temperature=0.3, base_url="http://localhost:11434",
+                 keep_alive="30m", residency=None, warm_up=False, limiter=None,
+                 stage_deadlines=None, hedge_base_url=None, use_agent=False, stage_metrics=None,
+                 stage_budgets=None, single_flight=None, coalesce=True):
         """
         初始化PPT生成器
         
@@ -25,69 +181,165 @@ class PPTGenerator:
             model: 使用的LLM模型名称
             temperature: 生成温度参数
             base_url: Ollama服务地址
+            keep_alive: 模型在Ollama中的驻留时间（如 "30m"、-1 表示常驻）
+            residency: 共享的ModelResidencyManager（可选，与图片识别共用时传入同一个实例）
+            warm_up: 是否在初始化时预热模型，避免首次调用的冷加载
+            limiter: 自适应并发限制器（可选，默认与同一Ollama地址的其他调用共享）
+            stage_deadlines: 各阶段的默认截止秒数，如 {"outline": 60, "image_usage": 30}
+            hedge_base_url: 对冲请求使用的第二个Ollama地址（可选）；阶段耗时超过其p95时向该地址发送重复请求
+            use_agent: 是否沿用经由ReAct智能体转发每个阶段的旧调度方式（各阶段无法共享提示词前缀，用于对比）
+            stage_metrics: 共享的StageMetrics（可选），记录各阶段预填充与生成的token数和耗时
+            stage_budgets: 覆盖默认的各阶段输出预算，如 {"outline": {"num_predict": 512}}
+            single_flight: 合并相同在途请求的SingleFlight（可选，默认进程内共享）
+            coalesce: 是否合并相同的在途生成与阶段调用
         """
         self.model = model
         self.temperature = temperature
         self.base_url = base_url
+        self.use_agent = use_agent
+        self.stage_metrics = stage_metrics or StageMetrics()
+        self.stage_budgets = {stage: dict(budget) for stage, budget in STAGE_BUDGETS.items()}
+        for stage, budget in (stage_budgets or {}).items():
+            self.stage_budgets.setdefault(stage, {}).update(budget)
         
-        # 初始化本地大模型
-        self.llm = ChatOllama(
-            model=model,
-            temperature=temperature,
-            base_url=base_url,
-            num_predict=4096
-        )
+        # 模型驻留管理：keep_alive 设置与加载/推理耗时统计
+        self.residency = residency or ModelResidencyManager(base_url, default_keep_alive=keep_alive)
+        self.residency.keep_alive.setdefault(model, keep_alive)
+        
+        # 同一Ollama服务的所有调用共享并发额度
+        self.limiter = limiter or get_limiter(base_url)
+        
+        # 相同文本、图片、风格和模型配置的在途生成及阶段调用只执行一次
+        self.single_flight = (single_flight or shared_single_flight()) if coalesce else None
+        
+        # 初始化本地大模型（智能体使用；各阶段的链使用按预算配置的实例）
+        self.llm = self._make_llm()
         
         # 初始化工具和智能体
         self._init_tools()
         self._init_agent()
         
+        # 阶段截止时间与对冲请求
+        self.stage_deadlines = dict(stage_deadlines or {})
+        self.latency = LatencyTracker()
+        self._hedge = None
+        if hedge_base_url:
+            self._hedge = PPTGenerator(model=model, temperature=temperature, base_url=hedge_base_url,
+                                       keep_alive=keep_alive, residency=self.residency, use_agent=use_agent,
+                                       stage_metrics=self.stage_metrics, stage_budgets=stage_budgets,
+                                       single_flight=self.single_flight, coalesce=coalesce)
+        
+        if warm_up:
+            self.warm_up()
+        
         print(f"✅ PPTGenerator已初始化，使用模型: {model}")
     
+    def warm_up(self):
+        """
+        预热文本模型，使首次生成不必等待模型加载
+        
+        返回:
+            {模型名称: 加载耗时(秒)}
+        """
+        return self.residency.warm_up([self.model])
+    
+    def _model_config(self):
+        """合并请求时用于区分模型配置的部分"""
+        return [self.model, self.temperature, self.base_url, self.use_agent, self.stage_budgets]
+    
+    def _coalesce(self, key_parts, func, deadline=None):
+        """
+        相同键的在途调用共享一次执行（未启用合并时直接执行）
+        
+        deadline: 调用方自己的截止时间；等待其他调用方的结果时最多等到此时，默认取当前上下文的截止时间
+        """
+        if self.single_flight is None:
+            return func()
+        return self.single_flight.do(make_key(self._model_config(), *key_parts), func, deadline=deadline)
+    
+    async def _acoalesce(self, key_parts, factory, deadline=None):
+        if self.single_flight is None:
+            return await factory()
+        coalesced = self.single_flight.ado(make_key(self._model_config(), *key_parts), factory)
+        if deadline is None:
+            return await coalesced
+        return await await_deadline(coalesced, deadline)
+    
+    def _make_llm(self, stage=None):
+        """
+        创建本地大模型实例
+        
+        参数:
+            stage: 阶段名称；指定时按 stage_budgets 设置 num_predict、停止序列和JSON输出格式
+        """
+        budget = self.stage_budgets.get(stage, {}) if stage else {}
+        return LimitedChatOllama(
+            limiter=self.limiter,
+            model=self.model,
+            temperature=self.temperature,
+            base_url=self.base_url,
+            num_predict=budget.get("num_predict", 4096),
+            stop=budget.get("stop"),
+            format="json" if budget.get("json") else None,
+            keep_alive=self.residency.keep_alive_for(self.model),
+            callbacks=[self.residency.callback_handler(self.model), StageMetricsCallback(self.stage_metrics)]
+        )
+    
     def _init_tools(self):
         """
         初始化所有工具函数
+        
+        各阶段提示词都以相同的 SHARED_PREFIX（系统说明 + 原始文本）开头，阶段指令放在后面，
+        同一文档的各阶段连续调用时 Ollama 可以复用已缓存的前缀，不必重复处理整段原文。
         """
         # --- 工具1：提取重点 ---
         key_points_prompt = PromptTemplate.from_template(
-            "请从以下文本中提取3-5个最重要的要点。\n\n文本：{text}"
+            SHARED_PREFIX + "任务：请从以上文本中提取3-5个最重要的要点。"
         )
-        self.key_points_chain = LLMChain(llm=self.llm, prompt=key_points_prompt)
+        self.key_points_chain = LLMChain(llm=self._make_llm("key_points"), prompt=key_points_prompt)
         
         def extract_key_points(text: str) -> str:
             result = self.key_points_chain.invoke({"text": text})
             return result["text"].strip()
         
+        # --- 一句话摘要 ---
+        summary_prompt = PromptTemplate.from_template(
+            SHARED_PREFIX + "任务：请用一句话总结以上文本。"
+        )
+        self.summary_chain = LLMChain(llm=self._make_llm("summary"), prompt=summary_prompt)
+        
         # --- 工具2：生成提纲 ---
         outline_prompt = PromptTemplate.from_template(
-            "请根据以下文本生成一个逻辑清晰的提纲，包含3-5个主要章节。\n\n文本：{text}"
+            SHARED_PREFIX + "任务：请根据以上文本生成一个逻辑清晰的提纲，包含3-5个主要章节。"
         )
-        self.outline_chain = LLMChain(llm=self.llm, prompt=outline_prompt)
+        self.outline_chain = LLMChain(llm=self._make_llm("outline"), prompt=outline_prompt)
         
         def generate_outline(text: str) -> str:
             result = self.outline_chain.invoke({"text": text})
             return result["text"].strip()
         
         # --- 工具3：分析图片用途 ---
+        # 提纲紧跟在共享前缀之后，同一文档的所有图片请求共享“前缀 + 提纲”
         image_usage_prompt = PromptTemplate.from_template(
-            """
-            你是一个PPT视觉设计专家。请根据图片描述判断其最适合插入PPT的哪个部分。
+            SHARED_PREFIX + OUTLINE_SECTION + dedent("""\
+                任务：你是一个PPT视觉设计专家。请根据图片描述判断其最适合插入PPT的哪个部分。
 
-            图片URL: {image_url}
-            描述: {caption}
+                图片URL: {image_url}
+                描述: {caption}
 
-            请回答：
-            - 建议插入章节：
-            - 用途（如产品展示、数据对比等）：
-            - 布局建议（如居中大图、侧边配文等）：
-            """
+                请回答：
+                - 建议插入章节：
+                - 用途（如产品展示、数据对比等）：
+                - 布局建议（如居中大图、侧边配文等）：""")
         )
-        self.image_usage_chain = LLMChain(llm=self.llm, prompt=image_usage_prompt)
+        self.image_usage_chain = LLMChain(llm=self._make_llm("image_usage"), prompt=image_usage_prompt)
         
         def analyze_image_usage(image_info: str) -> str:
             try:
                 info = json.loads(image_info)
                 result = self.image_usage_chain.invoke({
+                    "text": info.get("text", ""),
+                    "outline": info.get("outline", ""),
                     "image_url": info["url"],
                     "caption": info["caption"]
                 })
@@ -97,31 +349,23 @@ class PPTGenerator:
         
         # --- 工具4：生成最终PPT代码提示词 ---
         final_prompt_template = PromptTemplate.from_template(
-            """
-            请根据以下信息，生成一段**详细、结构清晰的提示词**，用于指导大模型生成PPT代码（如 Reveal.js / HTML / python-pptx）。
-
-            =============== 输入信息 ===============
-            【核心文本】
-            {text}
+            SHARED_PREFIX + OUTLINE_SECTION + dedent("""\
+                【图片使用建议】
+                {image_suggestions}
 
-            【结构提纲】
-            {outline}
+                任务：请根据以上信息，生成一段**详细、结构清晰的提示词**，用于指导大模型生成PPT代码（如 Reveal.js / HTML / python-pptx）。
 
-            【图片使用建议】
-            {image_suggestions}
-
-            =============== 输出要求 ===============
-            请生成提示词，包含：
-            1. PPT整体风格（如科技感、极简风、商务蓝等）
-            2. 每页标题、内容要点、布局（图文排版注意并列，递进关系）
-            3. 图片插入位置（直接使用URL）
-            4. 是否需要动画、图表、过渡效果
-            5. 推荐输出格式（如 HTML+CSS+JS 或 Python脚本）
-            6. 需要有目录页
-            请确保提示词足够详细，能让代码生成模型准确生成PPT代码。
-            """
+                =============== 输出要求 ===============
+                请生成提示词，包含：
+                1. PPT整体风格（如科技感、极简风、商务蓝等）
+                2. 每页标题、内容要点、布局（图文排版注意并列，递进关系）
+                3. 图片插入位置（直接使用URL）
+                4. 是否需要动画、图表、过渡效果
+                5. 推荐输出格式（如 HTML+CSS+JS 或 Python脚本）
+                6. 需要有目录页{style_instruction}
+                请确保提示词足够详细，能让代码生成模型准确生成PPT代码。""")
         )
-        self.final_prompt_chain = LLMChain(llm=self.llm, prompt=final_prompt_template)
+        self.final_prompt_chain = LLMChain(llm=self._make_llm("final_prompt"), prompt=final_prompt_template)
         
         def generate_final_ppt_prompt(inputs: str) -> str:
             try:
@@ -129,12 +373,44 @@ class PPTGenerator:
                 result = self.final_prompt_chain.invoke({
                     "text": data["text"],
                     "outline": data["outline"],
-                    "image_suggestions": data["image_suggestions"]
+                    "image_suggestions": data["image_suggestions"],
+                    "style_instruction": data.get("style_instruction", "")
                 })
                 return result["text"].strip()
             except Exception as e:
                 return f"生成最终提示词失败：{str(e)}"
         
+        # --- 结构化幻灯片模型（供确定性渲染器使用，无需再经过代码生成模型）---
+        slide_model_template = PromptTemplate.from_template(
+            SHARED_PREFIX + OUTLINE_SECTION + dedent("""\
+                【可用图片】（按序号引用）
+                {images}
+
+                任务：请根据以上信息设计PPT的幻灯片结构，只输出一个JSON对象，不要输出任何解释。
+
+                JSON格式：
+                {{"title": "演示文稿标题", "subtitle": "副标题", "slides": [
+                    {{"title": "页标题", "bullets": ["要点1", "要点2"],
+                      "images": [{{"index": 1, "layout": "right"}}], "notes": "演讲者备注"}}
+                ]}}
+
+                要求：
+                1. 每页3-5个简洁要点，每个要点不超过30字
+                2. images 中只引用上面列出的图片序号，layout 为 "right"（侧边配图）或 "full"（整页大图）
+                3. 不需要封面和目录页，它们会自动生成""")
+        )
+        self.slide_model_chain = LLMChain(llm=self._make_llm("slide_model"), prompt=slide_model_template)
+        
+        # 各阶段直接调用的链
+        self.stage_chains = {
+            "key_points": self.key_points_chain,
+            "summary": self.summary_chain,
+            "outline": self.outline_chain,
+            "image_usage": self.image_usage_chain,
+            "final_prompt": self.final_prompt_chain,
+            "slide_model": self.slide_model_chain,
+        }
+        
         # 工具列表
         self.tools = [
             Tool(
@@ -171,7 +447,7 @@ class PPTGenerator:
             handle_parsing_errors=True
         )
     
-    def load_images_from_folder(self, folder_path, max_images=10):
+    def load_images_from_folder(self, folder_path, max_images=DEFAULT_MAX_IMAGES):
         """
         从文件夹加载图片信息
         
@@ -180,7 +456,7 @@ class PPTGenerator:
             max_images: 最大加载图片数量
         
         返回:
-            图片信息列表 [{"url": "...", "caption": "..."}]
+            图片信息列表 [{"url": "...", "caption": "...", "path": "..."}]，path 为图片的绝对路径
         """
         if not os.path.exists(folder_path):
             print(f"❌ 图片文件夹不存在: {folder_path}")
@@ -201,28 +477,27 @@ class PPTGenerator:
                 print(f"⚠️  读取图片描述Excel失败: {str(e)}")
         
         # 加载图片文件
-        image_files = [f for f in os.listdir(folder_path) 
-                      if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif'))]
-        image_files = image_files[:max_images]
-        
         images = []
-        for img_file in image_files:
-            # 创建本地文件URL
-            img_path = os.path.join(folder_path, img_file)
-            img_url = f"file:///{img_path.replace('\\', '/')}"
+        for img_path in list_image_files(folder_path, max_images):
+            img_file = os.path.basename(img_path)
+            # 创建本地文件URL（相对路径先转为绝对路径，否则 file:/// 会被解析为根目录下的路径）
+            img_path = os.path.abspath(img_path)
+            img_url = Path(img_path).as_uri()
             
             # 获取描述，如果有
             caption = image_descriptions.get(img_file, f"图片: {img_file}")
             
             images.append({
                 "url": img_url,
-                "caption": caption
+                "caption": caption,
+                "path": img_path
             })
         
         print(f"📷 已加载 {len(images)} 张图片")
         return images
     
-    def generate(self, text, title=None, style="professional", images=None, image_folder=None, use_cloud_enhance=False):
+    def generate(self, text, title=None, style="professional", images=None, image_folder=None, use_cloud_enhance=False,
+                 deadline=None, stage_deadlines=None):
         """
         生成PPT代码提示词
         
@@ -233,18 +508,97 @@ class PPTGenerator:
             images: 图片列表 [{"url": "...", "caption": "..."}]（可选）
             image_folder: 图片文件夹路径（可选）
             use_cloud_enhance: 是否使用云端增强（暂未实现）
+            deadline: 整体截止秒数（可选），超时抛出 DeadlineExceeded 并中止进行中的Ollama请求
+            stage_deadlines: 本次调用的各阶段截止秒数（可选），覆盖初始化时的设置
         
         返回:
             生成的PPT代码提示词
         """
         print("🚀 开始生成PPT提示词...")
         
+        result = self.build_result(text, title=title, style=style, images=images, image_folder=image_folder,
+                                   deadline=deadline, stage_deadlines=stage_deadlines)
+        
+        # 保存结果到文件
+        output_file = "generated_ppt_prompt.txt"
+        with open(output_file, "w", encoding="utf-8") as f:
+            f.write(result["result"]["final_ppt_prompt"])
+        
+        print(f"✅ PPT提示词生成完成！已保存到: {output_file}")
+        print(f"📄 提示词长度: {len(result['result']['final_ppt_prompt'])} 字符")
+        
+        return output_file
+    
+    def build_result(self, text, title=None, style="professional", images=None, image_folder=None,
+                     deadline=None, stage_deadlines=None):
+        """
+        生成PPT提示词及中间结果，不写入文件
+        
+        风格要求作为提示词变量传入而不修改共享模板，因此同一个实例可以在多个线程中并发调用。
+        
+        参数:
+            text: 输入文本内容
+            title: PPT标题（可选）
+            style: PPT风格（professional, creative, minimal等）
+            images: 图片列表 [{"url": "...", "caption": "..."}]（可选）
+            image_folder: 图片文件夹路径（可选）
+            deadline: 整体截止秒数（可选）
+            stage_deadlines: 各阶段截止秒数（可选）；图片分析、摘要、重点超时时跳过该部分，提纲和最终提示词超时则抛出 DeadlineExceeded
+        
+        返回:
+            {"success": ..., "message": ..., "result": {"summary", "key_points", "outline", "image_suggestions", "final_ppt_prompt"}}
+        """
+        run_deadline = Deadline(deadline)
+        budgets = {**self.stage_deadlines, **(stage_deadlines or {})}
+        
         # 如果提供了图片文件夹，从文件夹加载图片
         if image_folder:
-            images = self.load_images_from_folder(image_folder)
+            with stage_scope("load_images"):
+                images = self.load_images_from_folder(image_folder)
         elif images is None:
             images = []
         
+        full_text, style_instruction = self._prepare_text(text, title, style)
+        
+        # 调用核心功能生成PPT提示词；相同的在途生成只执行一次，
+        # 实际执行受最先到达的调用方的截止时间约束，其他调用方最多等到各自的截止时间
+        return self._coalesce(["build_result", text, title, style, images],
+                              lambda: self._create_ppt_prompt(full_text, images, style_instruction, run_deadline, budgets),
+                              deadline=run_deadline)
+    
+    async def agenerate(self, text, title=None, style="professional", images=None, image_folder=None,
+                        deadline=None, stage_deadlines=None):
+        """
+        build_result 的异步版本，供 asyncio 服务直接调用
+        
+        各阶段通过 ChatOllama.ainvoke 调用，不打印进度、不写文件，结果直接返回；
+        读取图片文件夹等文件操作放到线程中执行，不阻塞事件循环。
+        同一实例可以在一个事件循环中并发执行大量生成，实际在途的Ollama请求数由共享的限制器控制。
+        
+        参数:
+            与 build_result 相同
+        
+        返回:
+            与 build_result 相同；另有 "degraded_stages" 列出因超时被跳过的阶段
+        """
+        run_deadline = Deadline(deadline)
+        budgets = {**self.stage_deadlines, **(stage_deadlines or {})}
+        
+        if image_folder:
+            images = await asyncio.to_thread(self.load_images_from_folder, image_folder)
+        elif images is None:
+            images = []
+        
+        full_text, style_instruction = self._prepare_text(text, title, style)
+        return await self._acoalesce(["build_result", text, title, style, images],
+                                     lambda: self._acreate_ppt_prompt(full_text, images, style_instruction,
+                                                                      run_deadline, budgets),
+                                     deadline=run_deadline)
+    
+    def _prepare_text(self, text, title, style):
+        """
+        返回 (加上标题的文本, 风格要求)
+        """
         # 如果指定了标题，添加到文本开头
         if title:
             full_text = f"标题: {title}\n\n{text}"
@@ -252,69 +606,308 @@ class PPTGenerator:
             full_text = text
         
         # 根据风格调整提示词
+        style_instruction = ""
         if style != "professional":
-            # 在最终提示词中加入风格要求
-            original_template = self.final_prompt_chain.prompt.template
             style_instruction = f"\n7. 风格要求：请使用{style}风格设计PPT，包括配色、字体和布局"
-            self.final_prompt_chain.prompt.template = original_template + style_instruction
+        return full_text, style_instruction
+    
+    def generate_deck(self, text, title=None, style="professional", images=None, image_folder=None,
+                      output_dir=".", formats=("pptx", "html"), deadline=None, stage_deadlines=None):
+        """
+        生成结构化幻灯片模型并直接渲染为 .pptx / Reveal.js HTML
         
-        # 调用核心功能生成PPT提示词
-        result = self._create_ppt_prompt(full_text, images)
+        与 generate 不同，这里不输出给代码生成模型的提示词，而是由大模型输出幻灯片模型JSON，
+        再由 ppt_renderer 按模板确定性地渲染，省去第二轮代码生成。
         
-        # 还原原始模板
-        if style != "professional":
-            self._init_tools()  # 重新初始化以恢复原始模板
+        参数:
+            text: 输入文本内容
+            title: PPT标题（可选）
+            style: PPT风格（professional, creative, minimal等）
+            images: 图片列表 [{"url": "...", "caption": "..."}]（可选）
+            image_folder: 图片文件夹路径（可选）
+            output_dir: 输出目录
+            formats: 输出格式，可选 "pptx"、"html"、"json"
+            deadline: 整体截止秒数（可选）
+            stage_deadlines: 各阶段截止秒数（可选）；幻灯片结构超时时直接根据提纲生成
         
-        # 保存结果到文件
-        output_file = "generated_ppt_prompt.txt"
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(result["result"]["final_ppt_prompt"])
+        返回:
+            {格式: 文件路径}
+        """
+        print("🚀 开始生成PPT...")
+        run_deadline = Deadline(deadline)
+        budgets = {**self.stage_deadlines, **(stage_deadlines or {})}
         
-        print(f"✅ PPT提示词生成完成！已保存到: {output_file}")
-        print(f"📄 提示词长度: {len(result['result']['final_ppt_prompt'])} 字符")
+        if image_folder:
+            with stage_scope("load_images"):
+                images = self.load_images_from_folder(image_folder)
+        elif images is None:
+            images = []
         
-        return output_file
+        full_text = f"标题: {title}\n\n{text}" if title else text
+        outline, image_suggestions = self._analyze_inputs(full_text, images, run_deadline, budgets)
+        
+        print("🧩 正在生成幻灯片结构...")
+        image_list = "\n\n".join(
+            f"{suggestion}\n描述: {img['caption']}"
+            for img, suggestion in zip(images, image_suggestions)
+            if suggestion is not None
+        ) or "无"
+        raw = self._run_stage("slide_model", lambda gen: gen._invoke_stage("slide_model", {
+            "text": full_text,
+            "outline": outline,
+            "images": image_list
+        }), run_deadline, budgets, fallback=None)
+        
+        data = ppt_renderer.parse_slide_model(raw)
+        if data and data["slides"]:
+            deck = ppt_renderer.normalize_slide_model(data, title=title, style=style, images=images)
+        else:
+            print("⚠️  幻灯片结构JSON解析失败，改为直接根据提纲生成")
+            deck = ppt_renderer.build_slide_model(outline, title=title, style=style, images=images)
+        deck = ppt_renderer.with_toc(deck)
+        
+        outputs = ppt_renderer.render_deck(deck, output_dir=output_dir, formats=formats)
+        for fmt, path in outputs.items():
+            print(f"✅ 已生成 {fmt}: {path}")
+        return outputs
     
-    def _create_ppt_prompt(self, text, images):
+    def _invoke_stage(self, stage, inputs):
         """
-        创建PPT提示词的核心方法
+        调用一个阶段：默认直接调用对应的链（共享前缀布局），use_agent=True 时经由智能体转发
+        
+        不同任务中相同的阶段调用（如同一文本的提纲、同一图片的分析）在途时只执行一次。
+        """
+        return self._coalesce(["stage", stage, inputs], lambda: self._call_stage(stage, inputs))
+    
+    async def _ainvoke_stage(self, stage, inputs):
+        """
+        _invoke_stage 的异步版本
+        """
+        return await self._acoalesce(["stage", stage, inputs], lambda: self._acall_stage(stage, inputs))
+    
+    def _call_stage(self, stage, inputs):
+        if self.use_agent and stage in AGENT_INPUTS:
+            return self.agent.invoke({"input": AGENT_INPUTS[stage].format(**inputs)})["output"]
+        chain = self.stage_chains[stage]
+        chain_inputs = {key: inputs[key] for key in chain.input_keys}
+        if self.stage_budgets.get(stage, {}).get("json"):
+            # 流式读取，JSON对象闭合后立即断开，不等模型输出多余内容直到 num_predict 上限
+            prompt = chain.prompt.format_prompt(**chain_inputs)
+            text, usage, complete = read_json_object(chain.llm.stream(prompt))
+            if complete:
+                self._record_early_stop(stage, prompt, usage)
+            return text
+        return chain.invoke(chain_inputs)["text"].strip()
+    
+    async def _acall_stage(self, stage, inputs):
+        if self.use_agent and stage in AGENT_INPUTS:
+            return (await self.agent.ainvoke({"input": AGENT_INPUTS[stage].format(**inputs)}))["output"]
+        chain = self.stage_chains[stage]
+        chain_inputs = {key: inputs[key] for key in chain.input_keys}
+        if self.stage_budgets.get(stage, {}).get("json"):
+            prompt = chain.prompt.format_prompt(**chain_inputs)
+            text, usage, complete = await aread_json_object(chain.llm.astream(prompt))
+            if complete:
+                self._record_early_stop(stage, prompt, usage)
+            return text
+        return (await chain.ainvoke(chain_inputs))["text"].strip()
+    
+    def _record_early_stop(self, stage, prompt, usage):
+        """
+        提前停止的流式调用没有 Ollama 的结束元数据（回调也不会收到 on_llm_end），
+        用估计的提示词 token 数和客户端计时补上，同时计入阶段统计和模型驻留统计
+        """
+        metadata = {**usage, "prompt_eval_count": estimate_tokens(prompt.to_string())}
+        self.stage_metrics.record(stage, metadata, early_stopped=True)
+        self.residency.record(self.model, metadata)
+    
+    def _run_stage(self, stage, func, deadline, budgets, fallback=_NO_FALLBACK):
+        """
+        在截止时间内执行一个阶段
+        
+        参数:
+            stage: 阶段名称（outline、image_usage、final_prompt、summary、key_points、slide_model）
+            func: 接收生成器实例的可调用对象；配置了对冲地址时会分别以本实例和对冲实例调用
+            deadline: 整体截止时间
+            budgets: 各阶段截止秒数
+            fallback: 阶段超时时返回的降级结果；未提供时抛出 DeadlineExceeded
+        
+        返回:
+            阶段结果
+        """
+        stage_deadline = deadline.child(budgets.get(stage))
+        start = time.perf_counter()
+        try:
+            stage_deadline.check(stage)
+            hedge_after = self.latency.percentile(stage) if self._hedge is not None else None
+            if hedge_after is not None:
+                def branch(gen):
+                    with stage_scope(stage):
+                        return func(gen)
+                result = hedged_call(lambda d: branch(self), lambda d: branch(self._hedge),
+                                     hedge_after, stage_deadline)
+            else:
+                with deadline_scope(stage_deadline), stage_scope(stage):
+                    result = func(self)
+        except DeadlineExceeded as e:
+            if fallback is _NO_FALLBACK:
+                raise
+            print(f"⚠️  阶段 {stage} 未在截止时间内完成，已降级跳过: {str(e)}")
+            return fallback
+        self.latency.record(stage, time.perf_counter() - start)
+        return result
+    
+    async def _arun_stage(self, stage, func, deadline, budgets, fallback=_NO_FALLBACK, degraded=None):
+        """
+        _run_stage 的异步版本：func 接收生成器实例并返回协程，超时时取消该协程
+        
+        参数:
+            degraded: 列表（可选），超时降级的阶段名称追加到其中
+        """
+        stage_deadline = deadline.child(budgets.get(stage))
+        start = time.perf_counter()
+        try:
+            hedge_after = self.latency.percentile(stage) if self._hedge is not None else None
+            with deadline_scope(stage_deadline), stage_scope(stage):
+                if hedge_after is not None:
+                    call = ahedged_call(lambda d: func(self), lambda d: func(self._hedge), hedge_after, stage_deadline)
+                else:
+                    call = func(self)
+                result = await await_deadline(call, stage_deadline, stage)
+        except DeadlineExceeded:
+            if fallback is _NO_FALLBACK:
+                raise
+            if degraded is not None:
+                degraded.append(stage)
+            return fallback
+        self.latency.record(stage, time.perf_counter() - start)
+        return result
+    
+    def _analyze_inputs(self, text, images, deadline, budgets):
+        """
+        分析文本提纲与图片使用建议
+        
+        返回:
+            (提纲, 图片建议列表)，建议列表与 images 一一对应，超时的图片对应 None
         """
         print("🔍 正在分析文本内容...")
-        outline = self.agent.invoke({"input": f"请为以下文本生成提纲：\n{text}"})["output"]
+        outline = self._run_stage("outline", lambda gen: gen._invoke_stage("outline", {
+            "text": text
+        }), deadline, budgets)
 
         image_suggestions = []
         if images:
             print(f"🖼️ 正在分析 {len(images)} 张图片的使用建议...")
-            for i, img in enumerate(images):
+            
+            def analyze(indexed):
+                i, img = indexed
                 print(f"  → 分析图片 {i+1}: {os.path.basename(img['url'])}")
-                img_json = json.dumps(img, ensure_ascii=False)
-                suggestion = self.agent.invoke({
-                    "input": f"请分析这张图片的用途：{img_json}"
-                })["output"]
-                image_suggestions.append(f"【图片{i+1}】\n{suggestion}")
+                suggestion = self._run_stage("image_usage", lambda gen: gen._invoke_stage("image_usage", {
+                    "text": text,
+                    "outline": outline,
+                    "image_url": img["url"],
+                    "caption": img["caption"],
+                    "image_json": json.dumps(img, ensure_ascii=False)
+                }), deadline, budgets, fallback=None)
+                return None if suggestion is None else f"【图片{i+1}】\n{suggestion}"
+            
+            # 并发分析图片，实际在途请求数由共享的限制器控制
+            with ThreadPoolExecutor(max_workers=min(len(images), self.limiter.max_limit)) as pool:
+                image_suggestions = list(pool.map(analyze, enumerate(images)))
         
-        image_suggestions_str = "\n\n".join(image_suggestions)
-
-        print("🎯 正在生成最终PPT代码提示词...")
+        return outline, image_suggestions
+    
+    async def _aanalyze_inputs(self, text, images, deadline, budgets, degraded=None):
+        """
+        _analyze_inputs 的异步版本，所有图片并发分析
+        """
+        outline = await self._arun_stage("outline", lambda gen: gen._ainvoke_stage("outline", {
+            "text": text
+        }), deadline, budgets)
+        
+        async def analyze(i, img):
+            suggestion = await self._arun_stage("image_usage", lambda gen: gen._ainvoke_stage("image_usage", {
+                "text": text,
+                "outline": outline,
+                "image_url": img["url"],
+                "caption": img["caption"],
+                "image_json": json.dumps(img, ensure_ascii=False)
+            }), deadline, budgets, fallback=None, degraded=degraded)
+            return None if suggestion is None else f"【图片{i+1}】\n{suggestion}"
+        
+        suggestions = await asyncio.gather(*(analyze(i, img) for i, img in enumerate(images)))
+        return outline, list(suggestions)
+    
+    def _final_inputs(self, text, outline, image_suggestions, style_instruction):
         final_inputs = {
             "text": text,
             "outline": outline,
-            "image_suggestions": image_suggestions_str
+            "image_suggestions": "\n\n".join(s for s in image_suggestions if s is not None),
+            "style_instruction": style_instruction
         }
-        final_input_json = json.dumps(final_inputs, ensure_ascii=False)
+        if self.use_agent:
+            final_inputs["final_input_json"] = json.dumps(final_inputs, ensure_ascii=False)
+        return final_inputs
+    
+    def _create_ppt_prompt(self, text, images, style_instruction="", deadline=None, budgets=None):
+        """
+        创建PPT提示词的核心方法
+        """
+        deadline = deadline or Deadline()
+        budgets = budgets or {}
+        
+        # 同一文档的所有阶段在此连续执行，共享前缀在Ollama中保持缓存；
+        # 可降级的摘要与重点放在最后，避免占用提纲和最终提示词的截止时间
+        outline, image_suggestions = self._analyze_inputs(text, images, deadline, budgets)
 
-        final_prompt = self.agent.invoke({
-            "input": f"请整合以下信息，生成PPT代码提示词：{final_input_json}"
-        })["output"]
+        print("🎯 正在生成最终PPT代码提示词...")
+        final_inputs = self._final_inputs(text, outline, image_suggestions, style_instruction)
+        final_prompt = self._run_stage("final_prompt", lambda gen: gen._invoke_stage("final_prompt", final_inputs),
+                                       deadline, budgets)
+        summary = self._run_stage("summary", lambda gen: gen._invoke_stage("summary", {
+            "text": text
+        }), deadline, budgets, fallback="")
+        key_points = self._run_stage("key_points", lambda gen: gen._invoke_stage("key_points", {
+            "text": text
+        }), deadline, budgets, fallback="")
 
         return {
             "success": True,
             "message": "PPT提示词生成成功",
             "result": {
-                "summary": self.agent.invoke({"input": f"请用一句话总结文本：\n{text}"})["output"],
-                "key_points": self.agent.invoke({"input": f"请提取重点：\n{text}"})["output"],
+                "summary": summary,
+                "key_points": key_points,
                 "outline": outline,
-                "image_suggestions": image_suggestions,
+                "image_suggestions": [s for s in image_suggestions if s is not None],
+                "final_ppt_prompt": final_prompt
+            }
+        }
+    
+    async def _acreate_ppt_prompt(self, text, images, style_instruction, deadline, budgets):
+        """
+        _create_ppt_prompt 的异步版本
+        """
+        degraded = []
+        outline, image_suggestions = await self._aanalyze_inputs(text, images, deadline, budgets, degraded)
+        final_inputs = self._final_inputs(text, outline, image_suggestions, style_instruction)
+        final_prompt = await self._arun_stage("final_prompt", lambda gen: gen._ainvoke_stage("final_prompt", final_inputs),
+                                              deadline, budgets)
+        summary = await self._arun_stage("summary", lambda gen: gen._ainvoke_stage("summary", {
+            "text": text
+        }), deadline, budgets, fallback="", degraded=degraded)
+        key_points = await self._arun_stage("key_points", lambda gen: gen._ainvoke_stage("key_points", {
+            "text": text
+        }), deadline, budgets, fallback="", degraded=degraded)
+        
+        return {
+            "success": True,
+            "message": "PPT提示词生成成功",
+            "degraded_stages": degraded,
+            "result": {
+                "summary": summary,
+                "key_points": key_points,
+                "outline": outline,
+                "image_suggestions": [s for s in image_suggestions if s is not None],
                 "final_ppt_prompt": final_prompt
             }
         }
@@ -340,11 +933,36 @@ class PPTGenerator:
             results.append(file_path)
         
         return results
+    
+    async def abatch_generate(self, texts, titles=None, style="professional", max_concurrency=None, deadline=None):
+        """
+        异步批量生成，所有文本并发执行，结果按输入顺序返回
+        
+        参数:
+            texts: 文本列表
+            titles: 标题列表（可选）
+            style: PPT风格
+            max_concurrency: 同时进行的生成数（可选）；Ollama在途请求数另由限制器控制
+            deadline: 每个生成的截止秒数（可选）
+        
+        返回:
+            与 agenerate 相同的结果字典列表；失败的项为 {"success": False, "message": 错误信息}
+        """
+        semaphore = asyncio.Semaphore(max_concurrency or max(1, len(texts)))
+        
+        async def run(i, text):
+            title = titles[i] if titles and i < len(titles) else f"演示文稿 {i+1}"
+            async with semaphore:
+                try:
+                    return await self.agenerate(text, title, style, deadline=deadline)
+                except Exception as e:
+                    return {"success": False, "message": f"PPT提示词生成失败: {str(e)}"}
+        
+        return await asyncio.gather(*(run(i, text) for i, text in enumerate(texts)))
 
-# 示例使用
-if __name__ == "__main__":
-    # 初始化生成器
-    generator = PPTGenerator()
+def _run_example():
+    # 初始化生成器（预热模型，避免首次调用冷加载）
+    generator = PPTGenerator(warm_up=True)
     
     # 准备输入文本
     input_text = """
@@ -370,7 +988,25 @@ if __name__ == "__main__":
     )
     
     print(f"\n🎉 PPT提示词已成功生成: {ppt_path}")
+    generator.residency.print_report()
+    generator.stage_metrics.print_report()
     print("\n📋 使用提示：")
     print("1. 打开生成的txt文件复制提示词")
     print("2. 将提示词粘贴到代码生成模型中")
-    print("3. 获取完整的PPT代码并保存为HTML或其他格式")
\ No newline at end of file
+    print("3. 获取完整的PPT代码并保存为HTML或其他格式")
+
+# 示例使用
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="根据示例文本生成PPT提示词")
+    parser.add_argument("--profile", nargs="?", const="profile_generate", metavar="PREFIX",
+                        help="剖析各阶段的CPU/等待Ollama时间与内存，输出 PREFIX.collapsed 等文件")
+    args = parser.parse_args()
+    
+    if args.profile:
+        from profiling import Profiler
+        with Profiler(args.profile):
+            _run_example()
+    else:
+        _run_example()
@@ -0,0 +1,447 @@
+# ppt_renderer.py
+# 结构化幻灯片模型 → python-pptx / Reveal.js 的确定性渲染器
+#
+# 幻灯片模型格式:
+# {
+#     "title": "演示文稿标题",
+#     "subtitle": "副标题",
+#     "style": "professional",
+#     "slides": [
+#         {
+#             "title": "页标题",
+#             "bullets": ["要点1", "要点2"],
+#             "images": [{"url": "...", "caption": "...", "layout": "right"}],
+#             "notes": "演讲者备注"
+#         }
+#     ]
+# }
+
+import html
+import json
+import os
+import re
+from string import Template
+from urllib.parse import unquote, urlparse
+
+# 预设风格：配色与字体
+STYLES = {
+    "professional": {
+        "background": "FFFFFF",
+        "title_color": "1E3A8A",
+        "text_color": "1E293B",
+        "accent": "2563EB",
+        "font": "Microsoft YaHei",
+        "reveal_theme": "white",
+    },
+    "creative": {
+        "background": "FDF4FF",
+        "title_color": "9333EA",
+        "text_color": "3B0764",
+        "accent": "F97316",
+        "font": "Microsoft YaHei",
+        "reveal_theme": "moon",
+    },
+    "minimal": {
+        "background": "FAFAFA",
+        "title_color": "111827",
+        "text_color": "374151",
+        "accent": "6B7280",
+        "font": "Microsoft YaHei",
+        "reveal_theme": "simple",
+    },
+}
+
+IMAGE_LAYOUTS = ("right", "full")
+
+_HEADING_RE = re.compile(r"^(#{1,3}\s*|[一二三四五六七八九十]+[、.．]\s*|第[一二三四五六七八九十\d]+[章部分节]\s*|\d+[.、．]\s*)")
+_BULLET_RE = re.compile(r"^([-*•·]\s*|\d+\.\d+[.、]?\s*|[（(]\d+[)）]\s*|[a-zA-Z][.)]\s*)")
+
+
+def get_style(style):
+    """返回风格配置，未知风格使用 professional"""
+    return STYLES.get(style, STYLES["professional"])
+
+
+def parse_slide_model(text):
+    """
+    从模型输出中解析幻灯片模型JSON
+
+    参数:
+        text: 模型输出文本，允许包含 ```json 代码块或前后说明文字
+
+    返回:
+        解析后的字典，无法解析时返回 None
+    """
+    if not text:
+        return None
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("slides"), list):
+        return None
+    return data
+
+
+def normalize_slide_model(data, title=None, style="professional", images=None):
+    """
+    校验并补全幻灯片模型
+
+    参数:
+        data: parse_slide_model 的结果
+        title: 演示文稿标题（优先于模型输出）
+        style: PPT风格
+        images: 图片列表 [{"url": "...", "caption": "..."}]，幻灯片中的 {"index": n} 按序号引用
+
+    返回:
+        规范化后的幻灯片模型
+    """
+    images = images or []
+    slides = []
+    for raw in data.get("slides", []):
+        if not isinstance(raw, dict):
+            continue
+        bullets = raw.get("bullets") or []
+        if isinstance(bullets, str):
+            bullets = [line for line in bullets.splitlines() if line.strip()]
+        slide_images = []
+        for img in raw.get("images") or []:
+            if isinstance(img, int):
+                img = {"index": img}
+            if not isinstance(img, dict):
+                continue
+            index = img.get("index")
+            if isinstance(index, int) and 1 <= index <= len(images):
+                resolved = dict(images[index - 1])
+            elif img.get("url"):
+                resolved = {"url": img["url"], "caption": img.get("caption", "")}
+            else:
+                continue
+            layout = img.get("layout")
+            resolved["layout"] = layout if layout in IMAGE_LAYOUTS else "right"
+            slide_images.append(resolved)
+        slides.append({
+            "title": str(raw.get("title", "")).strip(),
+            "bullets": [str(b).strip() for b in bullets if str(b).strip()],
+            "images": slide_images,
+            "notes": str(raw.get("notes", "")).strip(),
+        })
+    return {
+        "title": title or str(data.get("title", "")).strip() or "演示文稿",
+        "subtitle": str(data.get("subtitle", "")).strip(),
+        "style": style,
+        "slides": slides,
+    }
+
+
+def build_slide_model(outline, title=None, style="professional", images=None):
+    """
+    不经过大模型，直接从提纲文本构建幻灯片模型
+
+    提纲中的章节标题（"一、"、"1."、"##" 等）作为页标题，其下的行作为要点；
+    图片按顺序分配到各内容页。
+
+    参数:
+        outline: 提纲文本
+        title: 演示文稿标题
+        style: PPT风格
+        images: 图片列表 [{"url": "...", "caption": "..."}]
+
+    返回:
+        幻灯片模型
+    """
+    slides = []
+    current = None
+    for line in outline.splitlines():
+        line = line.strip().strip("*").strip()
+        if not line:
+            continue
+        if not slides and line.startswith("# "):
+            # 提纲开头的一级标题作为演示文稿标题
+            title = title or line[2:].strip()
+        elif _HEADING_RE.match(line) and not _BULLET_RE.match(line):
+            current = {"title": _HEADING_RE.sub("", line).strip(), "bullets": [], "images": [], "notes": ""}
+            slides.append(current)
+        elif current is None:
+            # 提纲开头的标题行
+            title = title or line.lstrip("#").strip()
+        else:
+            current["bullets"].append(_BULLET_RE.sub("", line).strip())
+
+    for i, img in enumerate(images or []):
+        if not slides:
+            break
+        slide = slides[i % len(slides)]
+        slide["images"].append({"url": img["url"], "caption": img.get("caption", ""), "layout": "right"})
+
+    return {"title": title or "演示文稿", "subtitle": "", "style": style, "slides": slides}
+
+
+def with_toc(deck):
+    """在内容页前插入目录页（已有目录页时原样返回）"""
+    slides = deck["slides"]
+    if slides and slides[0]["title"] in ("目录", "CONTENTS", "Contents"):
+        return deck
+    toc = {"title": "目录", "bullets": [s["title"] for s in slides if s["title"]], "images": [], "notes": ""}
+    return dict(deck, slides=[toc] + slides)
+
+
+# 右侧图片栏最多放置的图片数，其余图片的说明写入演讲者备注
+MAX_SIDE_IMAGES = 3
+
+
+def _local_image_path(image):
+    """
+    返回图片对应的本地文件路径，远程或不存在的图片返回 None
+
+    优先使用图片字典中的 "path"，否则把 file:/// URL 或本地路径形式的 "url" 转换为文件路径
+    """
+    path = image.get("path")
+    if path and os.path.isfile(path):
+        return path
+    url = image["url"]
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        path = unquote(parsed.path)
+        # Windows 路径形如 /C:/Users/...
+        if re.match(r"^/[A-Za-z]:/", path):
+            path = path[1:]
+    elif not parsed.scheme or len(parsed.scheme) == 1:
+        # 相对/绝对路径或 Windows 盘符路径
+        path = url
+    else:
+        return None
+    return path if os.path.isfile(path) else None
+
+
+def render_pptx(deck, output_path):
+    """
+    使用 python-pptx 渲染 .pptx 文件
+
+    参数:
+        deck: 幻灯片模型
+        output_path: 输出文件路径
+
+    返回:
+        输出文件路径
+    """
+    try:
+        from pptx import Presentation
+        from pptx.dml.color import RGBColor
+        from pptx.util import Inches, Pt
+    except ImportError:
+        raise ImportError("渲染 .pptx 需要 python-pptx，请运行: pip install python-pptx")
+
+    style = get_style(deck.get("style"))
+    prs = Presentation()
+    prs.slide_width = Inches(13.333)
+    prs.slide_height = Inches(7.5)
+
+    def paint(slide):
+        fill = slide.background.fill
+        fill.solid()
+        fill.fore_color.rgb = RGBColor.from_string(style["background"])
+
+    def place(shape, top, height):
+        # 版式占位符按 4:3 页面定义，改为宽屏后重新设置完整位置
+        shape.left, shape.top, shape.width, shape.height = Inches(0.5), top, Inches(12.3), height
+
+    def add_fitted_picture(slide, path, left, top, max_width, max_height):
+        # 按图片实际宽高比缩放到给定区域内，水平居中
+        picture = slide.shapes.add_picture(path, left, top)
+        scale = min(max_width / picture.width, max_height / picture.height)
+        picture.width, picture.height = int(picture.width * scale), int(picture.height * scale)
+        picture.left = left + (max_width - picture.width) // 2
+        return picture
+
+    def set_text(text_frame, text, size, color, bold=False):
+        text_frame.text = text
+        for paragraph in text_frame.paragraphs:
+            for run in paragraph.runs:
+                run.font.size = Pt(size)
+                run.font.bold = bold
+                run.font.name = style["font"]
+                run.font.color.rgb = RGBColor.from_string(color)
+
+    # 封面
+    cover = prs.slides.add_slide(prs.slide_layouts[0])
+    paint(cover)
+    place(cover.shapes.title, Inches(2.2), Inches(1.5))
+    place(cover.placeholders[1], Inches(3.9), Inches(1.0))
+    set_text(cover.shapes.title.text_frame, deck["title"], 44, style["title_color"], bold=True)
+    set_text(cover.placeholders[1].text_frame, deck.get("subtitle", ""), 24, style["accent"])
+
+    for data in deck["slides"]:
+        slide = prs.slides.add_slide(prs.slide_layouts[5])  # 仅标题
+        paint(slide)
+        place(slide.shapes.title, Inches(0.4), Inches(1.0))
+        set_text(slide.shapes.title.text_frame, data["title"], 32, style["title_color"], bold=True)
+
+        local_images = [(img, _local_image_path(img)) for img in data["images"]]
+        full = next(((img, path) for img, path in local_images if img["layout"] == "full" and path), None)
+        notes = [data["notes"]] if data["notes"] else []
+
+        if full:
+            # 整页图片：要点没有位置显示，与其他图片的说明一起写入演讲者备注
+            add_fitted_picture(slide, full[1], Inches(0.5), Inches(1.6), Inches(12.3), Inches(5.5))
+            notes += [f"• {bullet}" for bullet in data["bullets"]]
+            notes += [f"[图片] {img.get('caption', '')} {img['url']}" for img in data["images"] if img is not full[0]]
+        else:
+            text_width = Inches(12.3) if not data["images"] else Inches(7.2)
+            if data["bullets"]:
+                box = slide.shapes.add_textbox(Inches(0.5), Inches(1.6), text_width, Inches(5.4))
+                frame = box.text_frame
+                frame.word_wrap = True
+                for i, bullet in enumerate(data["bullets"]):
+                    paragraph = frame.paragraphs[0] if i == 0 else frame.add_paragraph()
+                    paragraph.text = f"• {bullet}"
+                    paragraph.space_after = Pt(10)
+                    for run in paragraph.runs:
+                        run.font.size = Pt(20)
+                        run.font.name = style["font"]
+                        run.font.color.rgb = RGBColor.from_string(style["text_color"])
+
+            # 右侧图片栏：每张图片按剩余高度平均分配，不超出页面底部
+            column = local_images[:MAX_SIDE_IMAGES]
+            notes += [f"[图片] {img.get('caption', '')} {img['url']}" for img, _ in local_images[MAX_SIDE_IMAGES:]]
+            top, bottom, gap = Inches(1.6), Inches(7.1), Inches(0.2)
+            for n, (img, path) in enumerate(column):
+                slot = (bottom - top - gap * (len(column) - n - 1)) // (len(column) - n)
+                if path:
+                    picture = add_fitted_picture(slide, path, Inches(8.0), top, Inches(4.8), slot)
+                    top += picture.height + gap
+                else:
+                    # 远程图片不下载，保留链接与说明
+                    height = min(Inches(1.0), slot)
+                    box = slide.shapes.add_textbox(Inches(8.0), top, Inches(4.8), height)
+                    box.text_frame.word_wrap = True
+                    set_text(box.text_frame, f"[图片] {img.get('caption', '')}\n{img['url']}", 12, style["accent"])
+                    top += height + gap
+
+        if notes:
+            slide.notes_slide.notes_text_frame.text = "\n".join(notes)
+
+    prs.save(output_path)
+    return output_path
+
+
+_REVEAL_TEMPLATE = Template("""<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>$title</title>
+    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/reveal.js@5/dist/reveal.css">
+    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/reveal.js@5/dist/theme/$theme.css">
+    <style>
+        .reveal h1, .reveal h2 { color: #$title_color; }
+        .reveal { color: #$text_color; font-family: "$font", sans-serif; }
+        .reveal .slide-body { display: flex; gap: 2em; align-items: flex-start; text-align: left; }
+        .reveal .slide-body ul { flex: 3; }
+        .reveal .slide-images { flex: 2; }
+        .reveal .slide-images img { max-height: 40vh; }
+        .reveal figcaption { font-size: 0.5em; color: #$accent; }
+    </style>
+</head>
+<body>
+<div class="reveal">
+    <div class="slides">
+$slides
+    </div>
+</div>
+<script src="https://cdn.jsdelivr.net/npm/reveal.js@5/dist/reveal.js"></script>
+<script src="https://cdn.jsdelivr.net/npm/reveal.js@5/plugin/notes/notes.js"></script>
+<script>
+    Reveal.initialize({ hash: true, transition: "slide", plugins: [RevealNotes] });
+</script>
+</body>
+</html>
+""")
+
+
+def _reveal_figure(img):
+    return (f'<figure><img src="{html.escape(img["url"], quote=True)}" '
+            f'alt="{html.escape(img.get("caption", ""), quote=True)}">'
+            f'<figcaption>{html.escape(img.get("caption", ""))}</figcaption></figure>')
+
+
+def render_revealjs(deck, output_path):
+    """
+    渲染 Reveal.js HTML 演示文稿
+
+    参数:
+        deck: 幻灯片模型
+        output_path: 输出文件路径
+
+    返回:
+        输出文件路径
+    """
+    style = get_style(deck.get("style"))
+    sections = [
+        "        <section>\n"
+        f"            <h1>{html.escape(deck['title'])}</h1>\n"
+        f"            <p>{html.escape(deck.get('subtitle', ''))}</p>\n"
+        "        </section>"
+    ]
+    for data in deck["slides"]:
+        bullets = "".join(f"<li>{html.escape(b)}</li>" for b in data["bullets"])
+        full = [img for img in data["images"] if img["layout"] == "full"]
+        side = [img for img in data["images"] if img["layout"] != "full"]
+        body = f'<div class="slide-body"><ul>{bullets}</ul>'
+        if side:
+            body += '<div class="slide-images">' + "".join(_reveal_figure(img) for img in side) + "</div>"
+        body += "</div>" + "".join(_reveal_figure(img) for img in full)
+        notes = f'<aside class="notes">{html.escape(data["notes"])}</aside>' if data["notes"] else ""
+        sections.append(
+            "        <section>\n"
+            f"            <h2>{html.escape(data['title'])}</h2>\n"
+            f"            {body}{notes}\n"
+            "        </section>"
+        )
+
+    content = _REVEAL_TEMPLATE.substitute(
+        title=html.escape(deck["title"]),
+        theme=style["reveal_theme"],
+        title_color=style["title_color"],
+        text_color=style["text_color"],
+        accent=style["accent"],
+        font=style["font"],
+        slides="\n".join(sections),
+    )
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    return output_path
+
+
+def render_deck(deck, output_dir=".", basename="generated_ppt", formats=("pptx", "html")):
+    """
+    按指定格式渲染幻灯片模型
+
+    参数:
+        deck: 幻灯片模型
+        output_dir: 输出目录
+        basename: 输出文件名（不含扩展名）
+        formats: 输出格式，可选 "pptx"、"html"、"json"
+
+    返回:
+        {格式: 文件路径}
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = {}
+    for fmt in formats:
+        path = os.path.join(output_dir, f"{basename}.{fmt}")
+        if fmt == "pptx":
+            outputs[fmt] = render_pptx(deck, path)
+        elif fmt == "html":
+            outputs[fmt] = render_revealjs(deck, path)
+        elif fmt == "json":
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(deck, f, ensure_ascii=False, indent=4)
+            outputs[fmt] = path
+        else:
+            raise ValueError(f"不支持的输出格式: {fmt}")
+    return outputs
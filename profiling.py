@@ -0,0 +1,218 @@
+# profiling.py
+# 性能剖析：定位生成慢在 Ollama、langchain 智能体解析/重试、JSON 序列化还是 pandas 读取 Excel
+#
+# Profiler 同时运行：
+#   - cProfile：调用线程（入口脚本的主线程）的函数级耗时，保存为 .pstats
+#   - 采样线程：定期抓取所有线程的调用栈，按阶段（stage_metrics.stage_scope）和类别归类，
+#     输出 flamegraph.pl / speedscope 可直接渲染的折叠栈文件 .collapsed
+#   - tracemalloc：各阶段执行期间相对进入时的内存增长峰值（见 stage_metrics.stage_memory_peaks）及分配最多的代码位置
+#
+# 每个采样按调用栈分为三类：
+#   - llm_wait: 位于 Ollama 调用内部且正阻塞在网络读取或等待并发额度上
+#   - wait: 其他阻塞（线程池空闲、等待队列等），不写入折叠栈文件
+#   - cpu: 本地执行（提示词拼接、输出解析、JSON 序列化、pandas 等）
+#
+# 用法:
+#     with Profiler("profile"):
+#         generator.generate(...)
+#     # 生成 profile.collapsed、profile.pstats、profile.json，并打印摘要
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+
+from stage_metrics import reset_stage_memory, sample_stage_memory, stage_memory_peaks, thread_stages, traced_peak
+
+# 发起 Ollama 请求的函数：(文件名, 函数名)
+LLM_CALL_FRAMES = {
+    ("concurrency.py", "_generate"),
+    ("concurrency.py", "_stream"),
+    ("concurrency.py", "_create_chat_stream"),
+    ("Image_Recognition.py", "_post_generate"),
+    ("model_residency.py", "warm_up"),
+    ("model_residency.py", "loaded_models"),
+}
+
+# 调用栈最内层的 Python 帧位于这些文件时，视为线程正阻塞（网络读取、锁、队列、select、空闲的线程池/进程池）
+BLOCKING_FILES = {"threading.py", "queue.py", "selectors.py", "socket.py", "ssl.py", "sync.py", "thread.py",
+                  "connection.py"}
+
+CATEGORIES = ("cpu", "llm_wait", "wait")
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def classify(codes):
+    """
+    判断一个调用栈的类别
+
+    参数:
+        codes: 从最外层到最内层的代码对象列表
+
+    返回:
+        "cpu"、"llm_wait" 或 "wait"
+    """
+    if not codes or os.path.basename(codes[-1].co_filename) not in BLOCKING_FILES:
+        return "cpu"
+    for code in codes:
+        if (os.path.basename(code.co_filename), code.co_name) in LLM_CALL_FRAMES:
+            return "llm_wait"
+    return "wait"
+
+
+class Profiler:
+    """
+    cProfile + 调用栈采样 + tracemalloc
+
+    参数:
+        output_prefix: 输出文件前缀，生成 <前缀>.collapsed / <前缀>.pstats / <前缀>.json
+        interval: 采样间隔（秒）
+        memory: 是否启用 tracemalloc（会明显拖慢执行，只在需要内存数据时开启）
+        top: 报告中列出的函数和分配位置数量
+    """
+
+    def __init__(self, output_prefix="profile", interval=0.005, memory=True, top=15):
+        self.output_prefix = output_prefix
+        self.interval = interval
+        self.memory = memory
+        self.top = top
+        self._stacks = Counter()
+        self._stage_samples = defaultdict(Counter)
+        self._stop = threading.Event()
+        self._sampler = None
+        self._profile = None
+        self._started = None
+        self._memory_base = 0
+        self._own_tracemalloc = False
+        self.report = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        self.print_report()
+        return False
+
+    def start(self):
+        """开始剖析"""
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._own_tracemalloc = True
+        if self.memory:
+            self._memory_base = tracemalloc.get_traced_memory()[0]
+            reset_stage_memory()
+        self._started = time.perf_counter()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, name="profiler-sampler", daemon=True)
+        self._sampler.start()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self):
+        """
+        停止剖析并写入输出文件
+
+        返回:
+            报告字典（同时写入 <前缀>.json）
+        """
+        self._profile.disable()
+        self._stop.set()
+        self._sampler.join()
+        elapsed = time.perf_counter() - self._started
+
+        top_allocations = []
+        peak = None
+        stage_peaks = {}
+        if self.memory:
+            peak = traced_peak() - self._memory_base
+            stage_peaks = stage_memory_peaks()
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            ])
+            for stat in snapshot.statistics("lineno")[:self.top]:
+                frame = stat.traceback[0]
+                top_allocations.append({"location": f"{frame.filename}:{frame.lineno}",
+                                        "size": stat.size, "count": stat.count})
+            if self._own_tracemalloc:
+                tracemalloc.stop()
+
+        collapsed_path = f"{self.output_prefix}.collapsed"
+        with open(collapsed_path, "w", encoding="utf-8") as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+        pstats_path = f"{self.output_prefix}.pstats"
+        self._profile.dump_stats(pstats_path)
+        buffer = io.StringIO()
+        pstats.Stats(self._profile, stream=buffer).sort_stats("cumulative").print_stats(self.top)
+
+        stages = {}
+        for stage in set(self._stage_samples) | set(stage_peaks):
+            samples = self._stage_samples[stage]
+            stages[stage] = {f"{category}_seconds": samples[category] * self.interval for category in CATEGORIES}
+            stages[stage]["peak_memory"] = stage_peaks.get(stage)
+
+        self.report = {
+            "elapsed": elapsed,
+            "interval": self.interval,
+            "samples": sum(self._stacks.values()),
+            "peak_memory": peak,
+            "stages": stages,
+            "top_allocations": top_allocations,
+            "cprofile": buffer.getvalue(),
+            "files": {"collapsed": collapsed_path, "pstats": pstats_path,
+                      "report": f"{self.output_prefix}.json"},
+        }
+        with open(self.report["files"]["report"], "w", encoding="utf-8") as f:
+            json.dump(self.report, f, ensure_ascii=False, indent=2)
+        return self.report
+
+    def print_report(self):
+        """打印各阶段的本地CPU/等待Ollama时间、内存增长峰值和耗时最多的函数"""
+        report = self.report
+        if report is None:
+            return
+        print(f"\n🔬 剖析结果（总耗时 {report['elapsed']:.2f} 秒，采样间隔 {report['interval'] * 1000:.0f} 毫秒）")
+        for stage, stats in sorted(report["stages"].items(), key=lambda item: -item[1]["cpu_seconds"]):
+            peak = stats["peak_memory"]
+            peak_text = f"，内存增长峰值 {peak / 1024 / 1024:.1f} MB" if peak is not None else ""
+            print(f"  {stage}: 本地CPU {stats['cpu_seconds']:.2f} 秒，等待Ollama {stats['llm_wait_seconds']:.2f} 秒，"
+                  f"其他等待 {stats['wait_seconds']:.2f} 秒{peak_text}")
+        if report["peak_memory"] is not None:
+            print(f"  整体内存峰值 {report['peak_memory'] / 1024 / 1024:.1f} MB，分配最多的位置:")
+            for allocation in report["top_allocations"][:5]:
+                print(f"    {allocation['size'] / 1024:.1f} KB  {allocation['location']}")
+        print(f"📁 折叠栈: {report['files']['collapsed']}（flamegraph.pl 或 speedscope 渲染）")
+        print(f"📁 cProfile: {report['files']['pstats']}，完整报告: {report['files']['report']}")
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            stages = thread_stages()
+            if self.memory:
+                sample_stage_memory()
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                codes.reverse()
+                category = classify(codes)
+                stage = stages.get(ident, "other")
+                self._stage_samples[stage][category] += 1
+                if category != "wait":
+                    self._stacks[(f"stage:{stage}", category, *map(_frame_label, codes))] += 1
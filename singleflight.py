@@ -0,0 +1,160 @@
+# singleflight.py
+# 合并相同的在途请求
+#
+# 同一文档在几秒内被重复提交（重试、前端重复点击、JSONL 中的重复行）时，
+# 只执行一次完整流程，所有调用方共享同一个结果；执行结束后不缓存结果，之后的调用会重新执行。
+#
+# - SingleFlight.do: 线程中使用，后到的调用方阻塞等待第一个调用方的结果
+# - SingleFlight.ado: asyncio 协程中使用，所有等待方都被取消时才取消实际执行的任务
+#
+# 第一个调用方因自己的截止时间或取消而失败（DeadlineExceeded）时，等待方不会收到这个错误，而是重新执行。
+
+import asyncio
+import copy
+import hashlib
+import json
+import threading
+
+from deadlines import DeadlineExceeded, current_deadline
+
+
+def make_key(*parts):
+    """
+    由任意可JSON序列化的部分生成请求键
+
+    返回:
+        sha256 十六进制字符串
+    """
+    data = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    相同键的在途调用只执行一次
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}  # (事件循环, 键) -> [任务, 等待数]
+        self._executions = 0
+        self._coalesced = 0
+
+    def do(self, key, func, deadline=None):
+        """
+        执行 func，或等待相同键的在途调用完成并返回其结果
+
+        参数:
+            key: 请求键（见 make_key）
+            func: 无参数的可调用对象
+            deadline: 等待其他调用方结果的截止时间（Deadline），默认取当前上下文的截止时间；
+                第一个调用方超时后重新等待时，按此时的剩余时间计算
+
+        返回:
+            func 的结果；等待方得到结果的深拷贝
+        """
+        if deadline is None:
+            deadline = current_deadline()
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                    self._executions += 1
+                else:
+                    self._coalesced += 1
+
+            if leader:
+                try:
+                    call.result = func()
+                    return call.result
+                except BaseException as e:
+                    call.error = e
+                    raise
+                finally:
+                    with self._lock:
+                        del self._calls[key]
+                    call.done.set()
+
+            timeout = None if deadline is None else deadline.remaining()
+            if not call.done.wait(timeout):
+                raise DeadlineExceeded("等待相同请求的结果超时")
+            if isinstance(call.error, DeadlineExceeded):
+                continue
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+    async def ado(self, key, factory):
+        """
+        do 的协程版本
+
+        参数:
+            key: 请求键（见 make_key）
+            factory: 无参数、返回协程的可调用对象
+
+        返回:
+            协程的结果；等待方得到结果的深拷贝
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = self._tasks.get((loop, key))
+            leader = entry is None
+            if leader:
+                task = asyncio.ensure_future(factory())
+                entry = self._tasks[(loop, key)] = [task, 0]
+                task.add_done_callback(lambda t, k=(loop, key): self._forget(k, t))
+                with self._lock:
+                    self._executions += 1
+            else:
+                with self._lock:
+                    self._coalesced += 1
+
+            task = entry[0]
+            entry[1] += 1
+            try:
+                result = await asyncio.shield(task)
+            except DeadlineExceeded:
+                if leader:
+                    raise
+                continue
+            finally:
+                entry[1] -= 1
+                # 所有等待方都已离开（如截止时间到达被取消）时才取消实际执行
+                if entry[1] == 0 and not task.done():
+                    task.cancel()
+            return result if leader else copy.deepcopy(result)
+
+    def _forget(self, key, task):
+        entry = self._tasks.get(key)
+        if entry is not None and entry[0] is task:
+            del self._tasks[key]
+
+    def stats(self):
+        """
+        返回:
+            {"executions": 实际执行次数, "coalesced": 被合并的调用次数, "in_flight": 在途键数}
+        """
+        with self._lock:
+            return {
+                "executions": self._executions,
+                "coalesced": self._coalesced,
+                "in_flight": len(self._calls) + len(self._tasks),
+            }
+
+
+_shared = SingleFlight()
+
+
+def shared_single_flight():
+    """返回进程内共享的 SingleFlight，不同 PPTGenerator 实例之间也能合并相同的请求"""
+    return _shared
@@ -0,0 +1,228 @@
+# stage_metrics.py
+# 按生成阶段统计 Ollama 的预填充（prompt eval）与生成（eval）开销
+#
+# 每个阶段还统计生成被 num_predict 截断（done_reason == "length"）和被提前停止的次数，用于调整各阶段的输出预算。
+#
+# 阶段名通过 contextvars 传递：PPTGenerator 在执行每个阶段时进入 stage_scope(stage)，
+# StageMetricsCallback 在 ChatOllama 返回后读取响应元数据并归入当前阶段。
+# 另外按线程记录当前阶段（thread_stages），供 profiling 中的采样线程按阶段归类调用栈；
+# tracemalloc 开启时还记录各阶段相对进入时的内存增长峰值（stage_memory_peaks）。
+
+import asyncio
+import contextvars
+import threading
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    from langchain_core.callbacks import BaseCallbackHandler
+except ImportError:  # 仅使用 HTTP 接口时不需要 langchain
+    BaseCallbackHandler = object
+
+from ollama_metadata import llm_result_metadata, seconds
+
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+_thread_stages = {}
+_memory_lock = threading.Lock()
+_memory_scopes = []  # 进行中的阶段: _MemoryScope
+_memory_peaks = {}   # 阶段名 -> 内存增长峰值（字节）
+_traced_peak = 0     # reset_peak 清除之前的 tracemalloc 峰值
+
+
+class _MemoryScope:
+    def __init__(self, stage, base):
+        self.stage = stage
+        self.base = base
+        self.peak = 0
+        # 期间没有其他阶段进行时，tracemalloc 的峰值只属于本阶段
+        self.exclusive = True
+
+
+def current_stage():
+    """返回当前上下文中的阶段名，没有则为 None"""
+    return _current_stage.get()
+
+
+@contextmanager
+def stage_scope(stage):
+    """在此范围内发起的 Ollama 调用计入 stage"""
+    token = _current_stage.set(stage)
+    # 事件循环线程中的协程交错进出阶段，按线程记录会留下过期的阶段，因此只在普通线程中记录
+    tag_thread = not _in_event_loop()
+    if tag_thread:
+        ident = threading.get_ident()
+        previous = _thread_stages.get(ident)
+        _thread_stages[ident] = stage
+    memory = _enter_memory_scope(stage) if tracemalloc.is_tracing() else None
+    try:
+        yield stage
+    finally:
+        if memory is not None:
+            _exit_memory_scope(memory)
+        _current_stage.reset(token)
+        if tag_thread:
+            if previous is None:
+                _thread_stages.pop(ident, None)
+            else:
+                _thread_stages[ident] = previous
+
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def thread_stages():
+    """返回 {线程ID: 当前阶段名}，不包含运行事件循环的线程"""
+    return dict(_thread_stages)
+
+
+def _enter_memory_scope(stage):
+    global _traced_peak
+    with _memory_lock:
+        if _memory_scopes:
+            for scope in _memory_scopes:
+                scope.exclusive = False
+            scope = _MemoryScope(stage, tracemalloc.get_traced_memory()[0])
+            scope.exclusive = False
+        else:
+            _traced_peak = max(_traced_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            scope = _MemoryScope(stage, tracemalloc.get_traced_memory()[0])
+        _memory_scopes.append(scope)
+    return scope
+
+
+def _exit_memory_scope(scope):
+    current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (scope.base, scope.base)
+    with _memory_lock:
+        _memory_scopes.remove(scope)
+        growth = max(scope.peak, current - scope.base)
+        if scope.exclusive:
+            growth = max(growth, peak - scope.base)
+        _memory_peaks[scope.stage] = max(_memory_peaks.get(scope.stage, 0), growth)
+
+
+def sample_stage_memory():
+    """
+    按当前内存更新进行中各阶段的增长峰值
+
+    多个阶段同时进行时无法区分各自的分配，由采样线程定期调用，
+    以各阶段进入时的内存为基线取样本中的最大增长。
+    """
+    if not tracemalloc.is_tracing():
+        return
+    current = tracemalloc.get_traced_memory()[0]
+    with _memory_lock:
+        for scope in _memory_scopes:
+            scope.peak = max(scope.peak, current - scope.base)
+
+
+def stage_memory_peaks():
+    """返回 {阶段名: 执行期间相对进入时的内存增长峰值（字节）}，只统计 tracemalloc 开启期间的阶段"""
+    with _memory_lock:
+        return dict(_memory_peaks)
+
+
+def traced_peak():
+    """tracemalloc 的内存峰值，包含 stage_scope 重置峰值之前的部分"""
+    with _memory_lock:
+        return max(_traced_peak, tracemalloc.get_traced_memory()[1])
+
+
+def reset_stage_memory():
+    """清空 stage_memory_peaks 的记录"""
+    global _traced_peak
+    with _memory_lock:
+        _memory_peaks.clear()
+        _traced_peak = 0
+
+
+class StageMetrics:
+    """
+    各阶段的调用次数、预填充 token 数/耗时、生成 token 数/耗时、截断与提前停止次数
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {
+            "calls": 0,
+            "prompt_tokens": 0,
+            "prefill_seconds": 0.0,
+            "output_tokens": 0,
+            "generation_seconds": 0.0,
+            "truncated": 0,
+            "early_stops": 0,
+        })
+
+    def record(self, stage, metadata, early_stopped=False):
+        """
+        记录一次调用
+
+        参数:
+            stage: 阶段名，None 时计入 "other"
+            metadata: Ollama 响应中的 prompt_eval_count、prompt_eval_duration、eval_count、eval_duration、done_reason
+            early_stopped: 是否在客户端提前停止（此时 metadata 中只有已接收的 token 数）
+        """
+        if not metadata:
+            return
+        with self._lock:
+            stats = self._stats[stage or "other"]
+            stats["calls"] += 1
+            stats["prompt_tokens"] += metadata.get("prompt_eval_count") or 0
+            stats["prefill_seconds"] += seconds(metadata, "prompt_eval_duration")
+            stats["output_tokens"] += metadata.get("eval_count") or 0
+            stats["generation_seconds"] += seconds(metadata, "eval_duration")
+            if metadata.get("done_reason") == "length":
+                stats["truncated"] += 1
+            if early_stopped:
+                stats["early_stops"] += 1
+
+    def report(self):
+        """
+        返回各阶段统计及每次调用的平均值
+
+        返回:
+            {阶段: {"calls", "prompt_tokens", "prefill_seconds", "output_tokens", "generation_seconds",
+                    "truncated", "early_stops", "avg_prompt_tokens", "avg_prefill_seconds", "avg_output_tokens"}}
+        """
+        with self._lock:
+            report = {}
+            for stage, stats in self._stats.items():
+                calls = max(1, stats["calls"])
+                report[stage] = dict(
+                    stats,
+                    avg_prompt_tokens=stats["prompt_tokens"] / calls,
+                    avg_prefill_seconds=stats["prefill_seconds"] / calls,
+                    avg_output_tokens=stats["output_tokens"] / calls,
+                )
+            return report
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def print_report(self):
+        """打印各阶段的预填充与生成统计"""
+        for stage, stats in self.report().items():
+            print(f"📊 {stage}: 调用 {stats['calls']} 次，平均预填充 {stats['avg_prompt_tokens']:.0f} tokens "
+                  f"({stats['avg_prefill_seconds']:.2f} 秒)，平均生成 {stats['avg_output_tokens']:.0f} tokens，"
+                  f"截断 {stats['truncated']} 次，提前停止 {stats['early_stops']} 次")
+
+
+class StageMetricsCallback(BaseCallbackHandler):
+    """
+    langchain 回调：把 ChatOllama 响应元数据记入当前阶段
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def on_llm_end(self, response, **kwargs):
+        stage = current_stage()
+        for metadata in llm_result_metadata(response):
+            self.metrics.record(stage, metadata)
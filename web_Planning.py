@@ -1,7 +1,7 @@
 # ai_ppt_agent.py
 # 基于文本和图片自动生成PPT代码提示词的智能体（修复 chat_history 错误）
 
-from langchain_ollama import ChatOllama
+from concurrency import LimitedChatOllama
 from langchain.agents import initialize_agent, AgentType
 from langchain.tools import Tool
 from langchain_core.prompts import PromptTemplate
@@ -13,7 +13,8 @@ import json
 os.environ["LANGCHAIN_TRACING_V2"] = "false"  # 可选
 
 # 初始化本地大模型
-llm = ChatOllama(
+# 所有调用经过该 Ollama 地址共享的自适应并发限制器（见 concurrency.py）
+llm = LimitedChatOllama(
     model="qwen2.5:7b",           # 确保这个模型已加载
     temperature=0.3,
     base_url="http://localhost:11434",